@@ -0,0 +1,121 @@
+"""
+Hit accuracy and routing latency of EoE.get_prompt_indices for several routing spaces.
+
+The routing statistics of the origin bert expert are fitted on synthetic gaussian features in the query space of
+bert-base (2 * 768 dims): num_tasks tasks of class_per_task classes, whose means share a low-rank structure and
+whose features share an anisotropic covariance. The test features of all tasks are then routed in batches of
+eval_batch_size, hit accuracy is the share of samples routed to the task of their class. The encoder is not run.
+
+    python benchmarks/routing_projection.py --routing_dims 32 128 512
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+
+import torch
+from transformers import BertConfig, BertModel
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from models import EoE  # noqa: E402
+
+
+def make_model(bert_path, args, routing_proj, routing_dim):
+    return EoE(SimpleNamespace(
+        device="cpu",
+        dataset_name="FewRel",
+        task_name="RelationExtraction",
+        model_name_or_path=bert_path,
+        additional_special_tokens_len=4,
+        peft_type="lora",
+        frozen=True,
+        class_per_task=args.class_per_task,
+        default_expert="task",
+        query_mode="mahalanobis",
+        max_expert=-1,
+        routing_proj=routing_proj,
+        routing_dim=routing_dim,
+    ))
+
+
+def make_tasks(args, dim):
+    """
+    Train and test features of every task, [class_per_task, n, dim] each.
+    """
+    generator = torch.Generator().manual_seed(args.seed)
+    # class means in a shared subspace of mean_rank dims, noise with a power-law spectrum in a random basis
+    mean_basis = torch.linalg.qr(torch.randn(dim, args.mean_rank, generator=generator))[0]
+    noise_basis = torch.linalg.qr(torch.randn(dim, dim, generator=generator))[0]
+    noise_scale = torch.arange(1, dim + 1, dtype=torch.float) ** -0.5
+    tasks = []
+    for _ in range(args.num_tasks):
+        means = args.mean_scale * torch.randn(args.class_per_task, args.mean_rank, generator=generator) @ mean_basis.T
+        splits = []
+        for n in [args.train_per_class, args.test_per_class]:
+            noise = torch.randn(args.class_per_task, n, dim, generator=generator) * noise_scale @ noise_basis.T
+            splits.append(means.unsqueeze(1) + noise)
+        tasks.append(splits)
+    return tasks
+
+
+def statistic(features):
+    # the statistics of EoETrainer.get_mean_and_cov: class means, averaged class covariance, task gaussian
+    mean = features.mean(dim=1)
+    cov = torch.stack([torch.cov(class_features.T) for class_features in features]).mean(dim=0)
+    all_features = features.reshape(-1, features.size(-1))
+    return mean, cov, all_features.mean(dim=0), torch.cov(all_features.T)
+
+
+@torch.no_grad()
+def run(bert_path, args, tasks, routing_proj, routing_dim):
+    model = make_model(bert_path, args, routing_proj, routing_dim)
+    for train_features, _ in tasks:
+        model.new_task(args.class_per_task)
+        model.new_statistic(*statistic(train_features), expert_id=-1)
+    test_features = torch.cat([test.reshape(-1, test.size(-1)) for _, test in tasks])
+    gold = torch.arange(len(tasks)).repeat_interleave(args.class_per_task * args.test_per_class)
+    batches = test_features.split(args.eval_batch_size)
+    times = []
+    for _ in range(args.repeats + 1):
+        start_time = time.perf_counter()
+        preds = torch.cat([model.get_prompt_indices(batch, expert_id=-1)[0] for batch in batches])
+        times.append(time.perf_counter() - start_time)
+    # the first pass is a warm-up
+    latency = sorted(times[1:])[len(times[1:]) // 2]
+    return (preds == gold).float().mean().item(), 1000 * latency / len(test_features)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--routing_dims", type=int, nargs="+", default=[32, 64, 128, 256, 512])
+    parser.add_argument("--num_tasks", type=int, default=10)
+    parser.add_argument("--class_per_task", type=int, default=8)
+    parser.add_argument("--train_per_class", type=int, default=320)
+    parser.add_argument("--test_per_class", type=int, default=50)
+    parser.add_argument("--mean_rank", type=int, default=64)
+    parser.add_argument("--mean_scale", type=float, default=0.05)
+    parser.add_argument("--eval_batch_size", type=int, default=64)
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as bert_path:
+        # only the hidden size matters, the routing statistics are fitted on the synthetic features
+        BertModel(BertConfig(vocab_size=100, hidden_size=768, num_hidden_layers=1, num_attention_heads=12,
+                             intermediate_size=3072)).save_pretrained(bert_path)
+        tasks = make_tasks(args, 2 * 768)
+        settings = [("none", -1)] + [(proj, k) for proj in ["pca", "random"] for k in args.routing_dims]
+        results = [run(bert_path, args, tasks, routing_proj, routing_dim) for routing_proj, routing_dim in settings]
+    # printed at the end, building the models prints the trainable parameters of every adapter
+    print(f"torch {torch.__version__}, {torch.get_num_threads()} threads, {args.num_tasks} tasks x "
+          f"{args.class_per_task} classes, {args.train_per_class} train / {args.test_per_class} test per class")
+    print(f"{'routing_proj':<14}{'k':>6}{'hit acc':>10}{'ms/sample':>12}")
+    for (routing_proj, routing_dim), (hit_acc, latency) in zip(settings, results):
+        k = 2 * 768 if routing_proj == "none" else routing_dim
+        print(f"{routing_proj:<14}{k:>6}{hit_acc:>10.4f}{latency:>12.4f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,17 +1,12 @@
+import json
 import logging
+import multiprocessing
 import os
 import random
-import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from types import SimpleNamespace
-import wandb as loggerdb
 import torch
-import torch.nn as nn
-import torch.distributed as dist
-from torch.nn.parallel import DistributedDataParallel as DDP
-
-
-
-
 
 import hydra
 import numpy as np
@@ -21,6 +16,9 @@ from transformers import AutoTokenizer, set_seed
 from data import FewRelData, TACREDData
 from models import ExpertModel, EoE
 from trainers import BaseTrainer, ExpertTrainer, EoETrainer
+from utils import JsonlSink, CsvSink, WandbSink, setup_metrics, log_metrics, close_metrics
+from utils import setup_checkpoints, close_checkpoints, setup_logging
+from utils import init_distributed, cleanup_distributed, is_main_process, is_distributed
 
 logger = logging.getLogger(__name__)
 
@@ -46,14 +44,119 @@ task_to_trainer = {
     "EoETrainer": EoETrainer,
 }
 
-wandb_api_key = "0806b2d5c00870a95f366d95c825d7680649abb7"  # Thay YOUR_WANDB_API_KEY bằng API key thực tế của bạn
 
-os.environ["WANDB_API_KEY"] = wandb_api_key
+def build_metrics_sinks(args, suffix=""):
+    sinks = []
+    for name in args.metrics_sinks if hasattr(args, "metrics_sinks") else ["jsonl"]:
+        if name == "jsonl":
+            sinks.append(JsonlSink(os.path.join(args.run_dir, f"metrics{suffix}.jsonl")))
+        elif name == "csv":
+            sinks.append(CsvSink(os.path.join(args.run_dir, f"metrics{suffix}.csv")))
+        elif name == "wandb":
+            # the api key is read from the WANDB_API_KEY environment variable
+            sinks.append(WandbSink(project=args.wandb_project if hasattr(args, "wandb_project") else "EOE_Sprint2"))
+        else:
+            raise NotImplementedError
+    return sinks
 
-loggerdb.login()
 
-# 1. Khởi tạo wandb
-loggerdb.init(project="EOE_Sprint2")
+def build_tokenizer(args):
+    return AutoTokenizer.from_pretrained(
+        args.tokenizer_name if args.tokenizer_name else args.model_name_or_path,
+        use_fast=args.use_fast_tokenizer,
+        additional_special_tokens=args.additional_special_tokens,
+    )
+
+
+def run_round(args, exp_idx, tokenizer):
+    exp_seed = args.seed + exp_idx * 100
+    set_seed(exp_seed)
+
+    data = task_to_data_reader[args.dataset_name](args)
+
+    label_list = data.label_list
+    task_seq = list(range(len(label_list)))
+    if len(task_seq) != args.num_tasks * args.class_per_task:
+        task_seq.extend([-1] * (args.num_tasks * args.class_per_task - len(task_seq)))
+        random.shuffle(task_seq)
+        task_seq = np.array(task_seq)
+    else:
+        random.shuffle(task_seq)
+        task_seq = np.argsort(task_seq)
+    if isinstance(args.class_per_task, int):
+        task_seq = task_seq.reshape((args.num_tasks, args.class_per_task)).tolist()
+    elif isinstance(args.class_per_task, list):
+        tmp_seq = []
+        cur = 0
+        for n in args.class_per_task:
+            tmp_seq.append(task_seq[cur:cur + n].tolist())
+            cur += n
+        task_seq = tmp_seq
+
+    data.read_and_preprocess(tokenizer, seed=exp_seed)
+
+    model = task_to_model[args.model_name](args)
+    model.to(args.device)
+
+    trainer = task_to_trainer[args.trainer_name](args=args)
+
+    return trainer.run(
+        data=data,
+        model=model,
+        tokenizer=tokenizer,
+        label_order=task_seq,
+        seed=exp_seed
+    )
+
+
+def run_round_in_worker(args, exp_idx, num_threads):
+    """
+    Run one experiment round in a pool process, pinned to num_threads cpu threads and, with several gpus,
+    to the gpu exp_idx % device_count.
+    """
+    setup_logging(args.log_file if hasattr(args, "log_file") else None)
+    torch.set_num_threads(num_threads)
+    if str(args.device).startswith("cuda") and torch.cuda.device_count() > 1:
+        args.device = f"cuda:{exp_idx % torch.cuda.device_count()}"
+        torch.cuda.set_device(args.device)
+    exp_seed = args.seed + exp_idx * 100
+    setup_checkpoints(args.async_checkpoints if hasattr(args, "async_checkpoints") else True)
+    setup_metrics(
+        build_metrics_sinks(args, f"-{exp_seed}"),
+        flush_every=args.metrics_flush_every if hasattr(args, "metrics_flush_every") else 50,
+    )
+    start_time = time.perf_counter()
+    exp_result = run_round(args, exp_idx, build_tokenizer(args))
+    logger.info("Ran round {} in {:.2f}s".format(exp_idx, time.perf_counter() - start_time))
+    close_checkpoints()
+    close_metrics()
+    return exp_result
+
+
+def run_rounds_in_pool(args, round_workers):
+    """
+    Run the experiment rounds concurrently in spawned processes. The result of every round is appended to
+    rounds.jsonl as soon as it finishes, the results are returned in round order.
+    """
+    num_threads = args.round_threads if hasattr(args, "round_threads") and args.round_threads > 0 else \
+        max(1, (os.cpu_count() or 1) // round_workers)
+    logger.info(f"run {args.num_exp_rounds} rounds in {round_workers} processes with {num_threads} threads each")
+    exp_results = [None] * args.num_exp_rounds
+    with ProcessPoolExecutor(max_workers=round_workers, mp_context=multiprocessing.get_context("spawn")) as executor:
+        futures = {
+            executor.submit(run_round_in_worker, args, exp_idx, num_threads): exp_idx
+            for exp_idx in range(args.num_exp_rounds)
+        }
+        with open(os.path.join(args.run_dir, "rounds.jsonl"), "a") as file:
+            for future in as_completed(futures):
+                exp_idx = futures[future]
+                exp_results[exp_idx] = future.result()
+                file.write(json.dumps({
+                    "exp_idx": exp_idx, "seed": args.seed + exp_idx * 100, **exp_results[exp_idx]
+                }) + "\n")
+                file.flush()
+                logger.info(f"round {exp_idx} finished: {exp_results[exp_idx]}")
+    return exp_results
 
 
 @hydra.main(version_base=None, config_path="configs", config_name="default")
@@ -64,13 +167,18 @@ def main(cfg: DictConfig):
     for k in args.__dict__:
         print(k + ": " + str(args.__dict__[k]))
 
-    logging.basicConfig(
-        format="%(asctime)s - %(le5velname)s - %(name)s - %(message)s",
-        datefmt="%m/%d/%Y %H:%M:%S",
-        handlers=[logging.StreamHandler(sys.stdout)],
-    )
+    setup_logging()
+
+    # checkpoints and results of this run, also used by the trainers and the round processes
+    args.run_dir = hydra.core.hydra_config.HydraConfig.get().runtime.output_dir
+    # the log file hydra writes for this process, the spawned worker processes append to it
+    args.log_file = os.path.join(args.run_dir, f"{hydra.core.hydra_config.HydraConfig.get().job.name}.log")
 
-    logger.setLevel(logging.INFO)
+    # under torchrun every process runs this function, the model is wrapped in DDP by the trainers
+    args.device = init_distributed(args.device)
+    # only the main process logs below warnings, for the loggers of all modules
+    setup_logging(level=logging.INFO if is_main_process() else logging.WARNING)
+    setup_checkpoints(args.async_checkpoints if hasattr(args, "async_checkpoints") else True)
 
     additional_special_tokens = task_to_additional_special_tokens[args.task_name] \
         if args.task_name in task_to_additional_special_tokens else []
@@ -78,65 +186,29 @@ def main(cfg: DictConfig):
     args.additional_special_tokens_len = len(additional_special_tokens)
 
     logger.info(f"additional special tokens: {additional_special_tokens}")
-    tokenizer = AutoTokenizer.from_pretrained(
-        args.tokenizer_name if args.tokenizer_name else args.model_name_or_path,
-        use_fast=args.use_fast_tokenizer,
-        additional_special_tokens=additional_special_tokens,
-    )
 
-    exp_results = []
     # conduct num_exp_rounds experiments and then calculate the average results
-    for exp_idx in range(args.num_exp_rounds):
-        exp_seed = args.seed + exp_idx * 100
-        set_seed(exp_seed)
-
-        data = task_to_data_reader[args.dataset_name](args)
-
-        label_list = data.label_list
-        task_seq = list(range(len(label_list)))
-        if len(task_seq) != args.num_tasks * args.class_per_task:
-            task_seq.extend([-1] * (args.num_tasks * args.class_per_task - len(task_seq)))
-            random.shuffle(task_seq)
-            task_seq = np.array(task_seq)
-        else:
-            random.shuffle(task_seq)
-            task_seq = np.argsort(task_seq)
-        if isinstance(args.class_per_task, int):
-            task_seq = task_seq.reshape((args.num_tasks, args.class_per_task)).tolist()
-        elif isinstance(args.class_per_task, list):
-            tmp_seq = []
-            cur = 0
-            for n in args.class_per_task:
-                tmp_seq.append(task_seq[cur:cur + n].tolist())
-                cur += n
-            task_seq = tmp_seq
-
-        data.read_and_preprocess(tokenizer, seed=exp_seed)
-
-        model = task_to_model[args.model_name](args)
-        
-        # Multi GPU
-        if torch.cuda.device_count() > 1:
-            print("Let's use", torch.cuda.device_count(), "GPUs!")
-            # dim = 0 [30, xxx] -> [10, ...], [10, ...], [10, ...] on 3 GPUs
-            model = nn.DataParallel(model)
-        
-        model.to(args.device)
-        
-        if isinstance(model, torch.nn.DataParallel):
-            print("Using GPUs:", model.device_ids)  # Xem danh sách GPU được sử dụng
-
-
-        trainer = task_to_trainer[args.trainer_name](args=args)
-
-        exp_result = trainer.run(
-            data=data,
-            model=model,
-            tokenizer=tokenizer,
-            label_order=task_seq,
-            seed=exp_seed
+    round_workers = min(args.round_workers if hasattr(args, "round_workers") else 0, args.num_exp_rounds)
+    if round_workers > 0 and is_distributed():
+        logger.warning("round_workers is ignored under torchrun, the rounds run one after another")
+        round_workers = 0
+    start_time = time.perf_counter()
+    if round_workers > 0:
+        exp_results = run_rounds_in_pool(args, round_workers)
+        setup_metrics(
+            build_metrics_sinks(args),
+            flush_every=args.metrics_flush_every if hasattr(args, "metrics_flush_every") else 50,
+        )
+    else:
+        setup_metrics(
+            build_metrics_sinks(args) if is_main_process() else [],
+            flush_every=args.metrics_flush_every if hasattr(args, "metrics_flush_every") else 50,
         )
-        exp_results.append(exp_result)
+        tokenizer = build_tokenizer(args)
+        exp_results = []
+        for exp_idx in range(args.num_exp_rounds):
+            exp_results.append(run_round(args, exp_idx, tokenizer))
+    logger.info("Ran {} rounds in {:.2f}s".format(args.num_exp_rounds, time.perf_counter() - start_time))
     # calculate the average results
     for k in exp_results[0].keys():
         avg_exp_results = [0] * args.num_tasks
@@ -146,11 +218,13 @@ def main(cfg: DictConfig):
             avg_exp_results[idx] = sum(c) / len(exp_results)
             avg_exp_results[idx] = round(avg_exp_results[idx], 2)
             std_exp_results[idx] = float(np.std(c))
-            loggerdb.log({f"train/{k}_avg": avg_exp_results[idx]})
-            loggerdb.log({f"train/{k}_std": std_exp_results[idx]})
+            log_metrics({f"train/{k}_avg": avg_exp_results[idx], f"train/{k}_std": std_exp_results[idx]})
         logger.info(f"{k} average : {avg_exp_results}")
         logger.info(f"{k}  std    : {std_exp_results}")
     logger.info("Training end !")
+    close_checkpoints()
+    close_metrics()
+    cleanup_distributed()
 
 
 if __name__ == "__main__":
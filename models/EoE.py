@@ -1,5 +1,8 @@
 import copy
+import logging
+import time
 from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
 from typing import Optional, Tuple
 
@@ -7,12 +10,12 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
-from models import PeftFeatureExtractor
-from utils import mahalanobis
+from models import PeftFeatureExtractor, ExpertStore
+from utils import mahalanobis, log_metrics, save_checkpoint, PackedCheckpoint, resident_memory_mb, mark_mapped
 
 import re
-import wandb as loggerdb
 
+logger = logging.getLogger(__name__)
 
 
 class EoE(nn.Module):
@@ -24,6 +27,26 @@ class EoE(nn.Module):
         self.peft_type = config.peft_type
         self.query_mode = config.query_mode
         self.max_expert = config.max_expert if config.max_expert != -1 else float("inf")
+        self.routing_proj = config.routing_proj if hasattr(config, "routing_proj") else "none"
+        self.routing_dim = config.routing_dim if hasattr(config, "routing_dim") else -1
+        # int for all experts or one value per expert (origin bert first), -1 scores every task
+        self.coarse_top_m = config.coarse_top_m if hasattr(config, "coarse_top_m") else -1
+        # only run the adapters of the top-k tasks of the origin bert at inference (-1: run all experts)
+        self.expert_topk = config.expert_topk if hasattr(config, "expert_topk") else -1
+        self.num_expert_passes = 0
+        # with profile_routing, the wall time of each routing call (get_prompt_indices) at inference without the
+        # encoder forwards, the device is synchronized around every call
+        self.profile_routing = config.profile_routing if hasattr(config, "profile_routing") else False
+        self.routing_times = []
+        # run the experts of a batch concurrently in a thread pool (0: sequentially)
+        self.expert_workers = config.expert_workers if hasattr(config, "expert_workers") else 0
+        self.expert_intra_op_threads = config.expert_intra_op_threads \
+            if hasattr(config, "expert_intra_op_threads") else -1
+        if self.expert_workers > 0 and self.expert_intra_op_threads <= 0:
+            self.expert_intra_op_threads = max(1, torch.get_num_threads() // self.expert_workers)
+        self.expert_executor = None
+        # each task starts from a re-initialized description head instead of the one trained on the earlier tasks
+        self.independent_tasks = hasattr(config, "independent_tasks") and config.independent_tasks
 
         self.feature_extractor = PeftFeatureExtractor(config)
 
@@ -37,6 +60,10 @@ class EoE(nn.Module):
         if config.task_name == "RelationExtraction":
             self.classifier_hidden_size = 2 * self.feature_extractor.bert.config.hidden_size
             self.query_size = 2 * self.feature_extractor.bert.config.hidden_size
+        # dimension of the space where means, covariances and routing scores live
+        self.routing_size = self.query_size
+        if self.routing_proj != "none" and 0 < self.routing_dim < self.query_size:
+            self.routing_size = self.routing_dim
 
         self.dropout = nn.Dropout(self.feature_extractor.bert.config.hidden_dropout_prob)
         self.n_layer = self.feature_extractor.bert.config.num_hidden_layers
@@ -45,21 +72,55 @@ class EoE(nn.Module):
         self.hidden_size = self.feature_extractor.bert.config.hidden_size
 
         # 0-bert 1-10 task
-        self.expert_distribution = [
-            {
-                "class_mean": [],
-                "accumulate_cov": torch.zeros(self.query_size, self.query_size),
-                "cov_inv": torch.ones(self.query_size, self.query_size),
-            }
-        ]
+        self.expert_distribution = [self.new_distribution(0)]
 
 
         self.tau = 0.8
+        # cache the embeddings of old-label descriptions, keyed by their token ids, and re-encode an entry only
+        # every description_bank_refresh steps; with momentum, a refreshed entry is blended with the cached one
+        self.description_bank = {} if hasattr(config, "description_bank") and config.description_bank else None
+        self.description_bank_refresh = config.description_bank_refresh \
+            if hasattr(config, "description_bank_refresh") else 1
+        self.description_bank_momentum = config.description_bank_momentum \
+            if hasattr(config, "description_bank_momentum") else 0.0
+        self.description_step = 0
+        self.description_bank_hits = 0
+        self.description_bank_misses = 0
         self.label_description = {}
         self.label_description_ids = {}
         self.number_description = 3
         self.classifier = nn.ParameterList()
 
+        self.model_name_or_path = config.model_name_or_path
+        self.expert_model = None
+        # packed checkpoint opened by load_packed and the experts not read from it yet
+        self.packed = None
+        self.packed_experts = set()
+        # keep at most resident_experts experts in memory, the others are paged out to expert_store_dir
+        self.expert_store = None
+        if hasattr(config, "resident_experts") and config.resident_experts > 0:
+            store_dir = config.expert_store_dir if hasattr(config, "expert_store_dir") else "./cache"
+            self.expert_store = ExpertStore(self, store_dir, config.resident_experts)
+
+    def close(self):
+        """
+        Shut down the expert thread pool, it is created again by the next concurrent run_experts, and delete
+        the trunk cache file and the expert store, whose paged out experts are lost.
+        """
+        if self.expert_executor is not None:
+            self.expert_executor.shutdown()
+            self.expert_executor = None
+        self.feature_extractor.close_trunk_cache()
+        if self.expert_store is not None:
+            self.expert_store.close()
+            self.expert_store = None
+
+    def __getstate__(self):
+        # a thread pool can't be pickled or copied, the copy creates its own
+        state = self.__dict__.copy()
+        state["expert_executor"] = None
+        return state
+
     def preprocess_text(self, text):
         text = text.lower()
         text = re.sub(r'[^a-zA-Z0-9.,?!()\s]', '', text)
@@ -107,8 +168,11 @@ class EoE(nn.Module):
         self.label_description_ids[label] = [self.preprocess_tokenize_desciption(desc, tokenizer) for desc in self.label_description[label]]
 
     def load_expert_model(self, expert_model):
+        self.use_expert(0, write=True)
+        self.expert_model = expert_model
         ckpt = torch.load(expert_model)
         self.feature_extractor.bert.load_state_dict(ckpt["model"])
+        self.feature_extractor.reset_trunk_cache()
         num_class = self.classifier[0].weight.shape[0]
         self.classifier[0].weight.data = ckpt["linear"]["weight"].data[:num_class].clone()
         self.classifier[0].bias.data = ckpt["linear"]["bias"].data[:num_class].clone()
@@ -123,46 +187,365 @@ class EoE(nn.Module):
             param.requires_grad = False
         new_classifier = nn.Linear(self.classifier_hidden_size, num_labels, device=self.device)
         self.classifier.append(new_classifier)
+        if self.independent_tasks:
+            self.feature_extractor.output_layer.reset_parameters()
 
         self.feature_extractor.add_adapter(self.num_tasks)
+        # the training sequences of the earlier tasks are evicted from the trunk cache, they are not trained again
+        self.feature_extractor.reset_trunk_cache()
+        # the cached description embeddings belong to the adapter of the previous task
+        if self.description_bank is not None:
+            self.description_bank = {}
+        self.description_step = 0
+        self.description_bank_hits = 0
+        self.description_bank_misses = 0
 
         # calculate distribution for each class with all expert model
-        self.expert_distribution.append({
-            "class_mean": [torch.zeros(self.class_per_task, self.query_size).to(self.device) for _ in
-                           range(self.num_tasks)],
-            "accumulate_cov": torch.zeros(self.query_size, self.query_size),
-            "cov_inv": torch.ones(self.query_size, self.query_size),
-        })
+        self.expert_distribution.append(self.new_distribution(self.num_tasks))
+        self.use_expert(self.num_tasks, write=True)
+
+    def distribution_fields(self):
+        # the per-task lists end with _mean, the query-space statistics are only kept with a routing projection
+        fields = ["class_mean", "accumulate_cov", "cov_inv", "task_mean", "accumulate_task_cov", "task_cov_inv", "proj"]
+        if self.routing_size < self.query_size:
+            fields += ["full_class_mean", "full_accumulate_cov", "full_task_mean", "full_accumulate_task_cov"]
+        return fields
+
+    def new_distribution(self, num_tasks):
+        """
+        Statistics of a new expert with placeholders for the num_tasks tasks learned before it. With a routing
+        projection, the statistics are also kept in the query space (the full_ fields) to fit the projection.
+        """
+        distribution = {}
+        for field in self.distribution_fields():
+            size = self.query_size if field.startswith("full_") else self.routing_size
+            if field.endswith("class_mean"):
+                distribution[field] = [torch.zeros(self.class_per_task, size).to(self.device) for _ in range(num_tasks)]
+            elif field.endswith("task_mean"):
+                distribution[field] = [torch.zeros(size).to(self.device) for _ in range(num_tasks)]
+            elif field.endswith("cov_inv"):
+                distribution[field] = torch.ones(size, size)
+            elif field.endswith("cov"):
+                distribution[field] = torch.zeros(size, size)
+            else:
+                distribution[field] = None
+        return distribution
+
+    def distribution_from_tensors(self, tensors, num_tasks):
+        """
+        Rebuild the statistics of an expert from tensors keyed by field, and by "<field>.<task>" for the per-task
+        lists of length num_tasks, as they are written by the expert store and the packed checkpoint.
+        """
+        return {
+            field: [tensors[f"{field}.{t}"] for t in range(num_tasks)] if field.endswith("_mean") else
+            tensors[field] if field in tensors else None
+            for field in self.distribution_fields()
+        }
 
     def save_classifier(self, idx, save_dir):
+        self.use_expert(idx)
         state_dict = self.classifier[idx].state_dict()
-        torch.save({
+        save_checkpoint({
             f"classifier": state_dict
         }, f"{save_dir}/classifier-{idx}.pth")
 
     def load_classifier(self, idx, save_dir):
+        self.use_expert(idx, write=True)
         ckpt = torch.load(f"{save_dir}/classifier-{idx}.pth")
         self.classifier[idx].load_state_dict(ckpt["classifier"])
 
+    def task_state_dict(self):
+        """
+        The weights that change from task to task and don't belong to an expert: the prompts and the
+        description head. The frozen backbones come from the pretrained model and the first-task checkpoint,
+        the adapters and classifiers are taken one expert at a time by expert_state_dict.
+        """
+        frozen = ("feature_extractor.bert.", "feature_extractor.origin_bert.", "feature_extractor.peft_bert.")
+        return {
+            k: v.detach().cpu() for k, v in self.state_dict().items()
+            if ("lora_" in k or not k.startswith(frozen)) and self.expert_of_key(k) is None
+        }
+
+    def expert_state_dict(self, e_id):
+        """
+        The adapter and classifier weights of expert e_id under their state dict keys. They are frozen after the
+        task of the expert, so they only need to be saved once. The tensors may be shared with the model.
+        """
+        adapter, classifier, _ = self.expert_state(e_id)
+        state = {f"feature_extractor.peft_bert.{k}": v.cpu() for k, v in adapter.items()}
+        for k, v in classifier.items():
+            state[f"classifier.{e_id}.{k}"] = v.cpu()
+        return state
+
+    def load_task_state_dict(self, state_dict, distribution):
+        """
+        Load the state of task_state_dict, merged with the expert_state_dict of every expert, and the statistics
+        of expert_distributions one expert at a time, the expert store pages the loaded experts out to stay within
+        its budget. Missing inverse covariances, see resume_distributions, are computed again.
+        """
+        expert_states = {}
+        shared_state = {}
+        for k, v in state_dict.items():
+            e_id = self.expert_of_key(k)
+            if e_id is None:
+                shared_state[k] = v
+            else:
+                expert_states.setdefault(e_id, {})[k] = v
+        unexpected_keys = [k for e_id, state in expert_states.items() if e_id > self.num_tasks for k in state]
+        for e_id in range(-1, self.num_tasks + 1):
+            self.use_expert(e_id, write=True)
+            self.load_state_dict(expert_states.get(e_id, {}), strict=False)
+            expert_id = self.shift_expert_id(e_id)
+            self.expert_distribution[expert_id] = self.distribution_to_device(distribution[expert_id])
+            if self.expert_distribution[expert_id].get("cov_inv") is None:
+                self.update_cov_inv(expert_id)
+        unexpected_keys += self.load_state_dict(shared_state, strict=False).unexpected_keys
+        if len(unexpected_keys) > 0:
+            raise KeyError(f"unexpected keys in task state: {unexpected_keys}")
+
+    @staticmethod
+    def expert_of_key(k):
+        """
+        The expert whose adapter or classifier holds the state dict key k, None for the shared weights.
+        """
+        match = re.search(r"\.lora_\w+\.task-(\d+)\.", k) or re.match(r"classifier\.(\d+)\.", k)
+        return int(match.group(1)) if match is not None else None
+
+    def expert_adapter_parameters(self, e_id):
+        if e_id < 0 or self.feature_extractor.peft_bert is None:
+            return {}
+        adapter_name = f"task-{e_id}"
+        return {
+            name: param for name, param in self.feature_extractor.peft_bert.named_parameters()
+            if f".{adapter_name}." in name
+        }
+
+    def expert_state(self, e_id):
+        """
+        The adapter parameters (by their peft_bert names), the classifier parameters and the statistics of
+        expert e_id without making it resident: a paged out expert is read from its store file, and these
+        tensors are not copied by a checkpoint snapshot.
+        """
+        self.load_packed_expert(e_id)
+        if self.expert_store is not None and self.expert_store.paged_out(e_id):
+            return mark_mapped(self.expert_store.read(e_id))
+        adapter = {name: param.data for name, param in self.expert_adapter_parameters(e_id).items()}
+        classifier = {name: param.data for name, param in self.classifier[e_id].named_parameters()} \
+            if e_id >= 0 else {}
+        return adapter, classifier, self.expert_distribution[self.shift_expert_id(e_id)]
+
+    def expert_distributions(self):
+        """
+        The statistics of all experts, e.g. to save them, taken one expert at a time by expert_state. The
+        statistics of paged out experts stay on the host.
+        """
+        return [self.expert_state(e_id)[2] for e_id in range(-1, self.num_tasks + 1)]
+
+    def resume_distributions(self):
+        """
+        The statistics of all experts without their inverse covariances, which load_task_state_dict derives
+        from the accumulated covariances. This halves the statistics written after every task.
+        """
+        return [
+            {field: value for field, value in distribution.items() if not field.endswith("cov_inv")}
+            for distribution in self.expert_distributions()
+        ]
+
+    def distribution_to_device(self, distribution):
+        # the accumulated covariances stay on the host like in new_task
+        return {
+            field: value if value is None or "accumulate_" in field else
+            [v.to(self.device) for v in value] if isinstance(value, list) else value.to(self.device)
+            for field, value in distribution.items()
+        }
+
+    def packed_state(self, labels=None):
+        """
+        Tensors and metadata of a packed checkpoint of the model: the adapters, classifiers and routing
+        statistics of all experts, grouped by expert. The frozen backbones are referenced by path and labels,
+        the labels in the order of the tasks, is kept to check the label order of the run that loads it.
+        The experts are taken one at a time by expert_state.
+        """
+        if self.peft_type != "lora":
+            raise NotImplementedError("packed checkpoints only hold lora experts")
+        tensors = {}
+        distributions = []
+        for e_id in range(-1, self.num_tasks + 1):
+            adapter, classifier, distribution = self.expert_state(e_id)
+            distributions.append(distribution)
+            for k, v in classifier.items():
+                tensors[f"classifier.{e_id}.{k}"] = v
+            # the keys of get_peft_model_state_dict, without the adapter name
+            for k, v in adapter.items():
+                tensors[f"adapter.{e_id}.{k.replace(f'.task-{e_id}.', '.')}"] = v
+        for k, v in self.feature_extractor.output_layer.state_dict().items():
+            tensors[f"output_layer.{k}"] = v
+        for i, distribution in enumerate(distributions):
+            for field, value in distribution.items():
+                if isinstance(value, list):
+                    for t, v in enumerate(value):
+                        tensors[f"distribution.{i}.{field}.{t}"] = v
+                elif value is not None:
+                    tensors[f"distribution.{i}.{field}"] = value
+        metadata = {
+            "model_name_or_path": self.model_name_or_path,
+            "expert_model": self.expert_model,
+            "peft_type": self.peft_type,
+            "query_mode": self.query_mode,
+            "routing_size": self.routing_size,
+            "num_labels": [classifier.out_features for classifier in self.classifier],
+            "num_class_means": [len(distribution["class_mean"]) for distribution in distributions],
+            "labels": labels,
+        }
+        return tensors, metadata
+
+    def load_packed(self, path, lazy=True):
+        """
+        Rebuild a fresh model from a packed checkpoint written from packed_state. The backbones are loaded
+        right away, the adapter, classifier and statistics of an expert are read from the mapped file when
+        the expert is first used, or all at once with lazy=False.
+        """
+        if self.peft_type != "lora":
+            raise NotImplementedError("packed checkpoints only hold lora experts")
+        start_time = time.perf_counter()
+        packed = PackedCheckpoint(path)
+        metadata = packed.metadata
+        if metadata["routing_size"] != self.routing_size or metadata["peft_type"] != self.peft_type:
+            raise ValueError(f"{path} was written with another peft_type or routing size")
+        # the placeholder experts are replaced by the packed ones, they don't go through the expert store
+        expert_store, self.expert_store = self.expert_store, None
+        for num_labels in metadata["num_labels"]:
+            self.new_task(num_labels)
+        self.load_expert_model(metadata["expert_model"])
+        self.expert_store = expert_store
+        for i in range(self.num_tasks + 1):
+            self.feature_extractor.register_adapter(i, save_dir=None, save=False)
+        self.feature_extractor.output_layer.load_state_dict(packed.get_prefix("output_layer."))
+        # the statistics are read together with their expert
+        self.expert_distribution = [None] * (self.num_tasks + 2)
+        self.packed = packed
+        self.packed_experts = set(range(-1, self.num_tasks + 1))
+        if not lazy:
+            for e_id in range(-1, self.num_tasks + 1):
+                self.load_packed_expert(e_id)
+        logger.info("load {} in {:.2f}s, resident memory {:.0f} MB".format(
+            path, time.perf_counter() - start_time, resident_memory_mb()))
+
+    def use_expert(self, e_id, write=False, evict=True):
+        """
+        Make the adapter, classifier and statistics of expert e_id available, from the packed checkpoint or the
+        expert store. write marks them as changed, evict=False defers the eviction of other experts.
+        """
+        self.load_packed_expert(e_id)
+        if self.expert_store is not None:
+            self.expert_store.touch(e_id, write=write, evict=evict)
+
+    def load_packed_expert(self, e_id):
+        if e_id not in self.packed_experts:
+            return
+        self.packed_experts.discard(e_id)
+        if e_id >= 0:
+            self.feature_extractor.load_adapter_state(e_id, self.packed.get_prefix(f"adapter.{e_id}."))
+            self.classifier[e_id].load_state_dict(self.packed.get_prefix(f"classifier.{e_id}."))
+        expert_id = self.shift_expert_id(e_id)
+        num_tasks = self.packed.metadata["num_class_means"][expert_id]
+        self.expert_distribution[expert_id] = self.distribution_to_device(
+            self.distribution_from_tensors(self.packed.get_prefix(f"distribution.{expert_id}."), num_tasks)
+        )
+
     def new_statistic(self, mean, cov, task_mean, task_cov, expert_id=0):
+        """
+        Add the class means, shared covariance and task-level gaussian of a task encoded by expert_id, in the
+        query space. With a routing projection they are kept in the full_ fields and the routing statistics
+        are projected from them by new_routing_projection.
+        """
+        self.use_expert(expert_id, write=True)
         expert_id = self.shift_expert_id(expert_id)
+        prefix = "full_" if self.routing_size < self.query_size else ""
+        self.expert_distribution[expert_id][f"{prefix}class_mean"].append(mean.to(self.device))
+        self.expert_distribution[expert_id][f"{prefix}accumulate_cov"] += cov
+        self.expert_distribution[expert_id][f"{prefix}task_mean"].append(task_mean.to(self.device))
+        self.expert_distribution[expert_id][f"{prefix}accumulate_task_cov"] += task_cov
+        if self.routing_size < self.query_size:
+            self.new_routing_projection(expert_id)
+        self.update_cov_inv(expert_id)
+
+    def num_encoded_tasks(self, expert_id):
+        # the tasks an expert (expert_id is already shifted) encoded, the statistics of earlier tasks are placeholders
         if expert_id == 0 or expert_id == 1:
-            length = self.num_tasks + 1
+            return self.num_tasks + 1
+        return self.num_tasks - expert_id + 2
+
+    def update_cov_inv(self, expert_id):
+        """
+        Invert the covariances accumulated by an expert (expert_id is already shifted), averaged over the
+        tasks it encoded.
+        """
+        length = self.num_encoded_tasks(expert_id)
+        distribution = self.expert_distribution[expert_id]
+        avg_cov = distribution["accumulate_cov"].to(self.device) / length
+        distribution["cov_inv"] = torch.linalg.pinv(avg_cov, hermitian=True)
+        avg_task_cov = distribution["accumulate_task_cov"].to(self.device) / length
+        distribution["task_cov_inv"] = torch.linalg.pinv(avg_task_cov, hermitian=True)
+
+    def new_routing_projection(self, expert_id):
+        """
+        Fit the projection of an expert (expert_id is already shifted) into the routing space and project its
+        statistics. PCA is fitted again after every task on the classes of all tasks the expert encoded: the
+        covariance of their pooled features is the averaged shared covariance plus the scatter of the class
+        means. The random projection is drawn once. The projection is linear, so the projected statistics match
+        the statistics of the projected features.
+        """
+        distribution = self.expert_distribution[expert_id]
+        if self.routing_proj == "pca":
+            num_tasks = self.num_encoded_tasks(expert_id)
+            class_means = torch.cat(distribution["full_class_mean"][-num_tasks:]).double()
+            pooled_cov = distribution["full_accumulate_cov"].to(class_means.device).double() / num_tasks + \
+                torch.cov(class_means.T, correction=0)
+            # principal axes of the pooled features, sorted by decreasing variance
+            _, eigenvectors = torch.linalg.eigh(pooled_cov)
+            # eigh returns column-major eigenvectors, keep the projection row-major like a reloaded one
+            proj = eigenvectors[:, -self.routing_size:].flip(-1).float().contiguous()
+        elif self.routing_proj == "random":
+            proj = distribution["proj"]
+            if proj is None:
+                generator = torch.Generator().manual_seed(expert_id)
+                proj = torch.randn(self.query_size, self.routing_size, generator=generator) / self.routing_size ** 0.5
         else:
-            length = self.num_tasks - expert_id + 2
-        self.expert_distribution[expert_id]["class_mean"].append(mean.cuda())
-        self.expert_distribution[expert_id]["accumulate_cov"] += cov
-        avg_cov = self.expert_distribution[expert_id]["accumulate_cov"].cuda() / length
-        self.expert_distribution[expert_id]["cov_inv"] = torch.linalg.pinv(avg_cov, hermitian=True)
+            raise NotImplementedError
+        distribution["proj"] = proj.to(self.device)
+        distribution["class_mean"] = [mean @ distribution["proj"] for mean in distribution["full_class_mean"]]
+        distribution["task_mean"] = [mean @ distribution["proj"] for mean in distribution["full_task_mean"]]
+        # the accumulated covariances stay on the host
+        proj = proj.cpu()
+        distribution["accumulate_cov"] = proj.T @ distribution["full_accumulate_cov"] @ proj
+        distribution["accumulate_task_cov"] = proj.T @ distribution["full_accumulate_task_cov"] @ proj
+
+    def project_prelogits(self, prelogits, expert_id=0):
+        proj = self.expert_distribution[self.shift_expert_id(expert_id)]["proj"]
+        if proj is None:
+            return prelogits
+        return prelogits @ proj
 
     def shift_expert_id(self, expert_id):
         return expert_id + 1
 
+    def get_coarse_top_m(self, expert_id):
+        if isinstance(self.coarse_top_m, int):
+            return self.coarse_top_m
+        return self.coarse_top_m[min(expert_id, len(self.coarse_top_m) - 1)]
+
     def get_prompt_indices(self, prelogits, expert_id=0):
+        prelogits = self.project_prelogits(prelogits, expert_id)
         expert_id = self.shift_expert_id(expert_id)
         task_means_over_classes = self.expert_distribution[expert_id]["class_mean"]
         cov_inv = self.expert_distribution[expert_id]["cov_inv"]
 
+        top_m = self.get_coarse_top_m(expert_id)
+        if 0 < top_m < len(task_means_over_classes) and self.query_mode in ["cosine", "euclidean", "mahalanobis"] \
+                and len(set(mean.shape for mean in task_means_over_classes)) == 1:
+            return self.get_prompt_indices_coarse_to_fine(prelogits, expert_id, top_m)
+
         scores_over_tasks = []
         class_indices_over_tasks = []
         # for each task
@@ -195,6 +578,233 @@ class EoE(nn.Module):
 
         return indices, scores_over_tasks, class_indices_over_tasks
 
+    def get_prompt_indices_coarse_to_fine(self, prelogits, expert_id, top_m):
+        """
+        Score every task with its task-level gaussian first and only score the classes of the top_m
+        candidate tasks of each sample. Tasks outside the candidates get an infinite score.
+        expert_id is already shifted.
+        """
+        distribution = self.expert_distribution[expert_id]
+        batch_size = prelogits.shape[0]
+        # [task_num, n]
+        task_scores = torch.stack([
+            mahalanobis(prelogits, task_mean, distribution["task_cov_inv"], norm=2)
+            for task_mean in distribution["task_mean"]
+        ])
+        # tasks learned before this expert only have placeholder statistics
+        task_scores[:max(expert_id - 1, 0)] = float("inf")
+        candidates = torch.topk(task_scores, k=top_m, dim=0, largest=False)[1]  # [top_m, n]
+
+        class_means = torch.stack(distribution["class_mean"])  # [task_num, num_labels, dim]
+        num_tasks, num_labels, _ = class_means.shape
+        scores_over_tasks = torch.full((num_tasks, batch_size), float("inf"), device=prelogits.device)
+        class_indices_over_tasks = (torch.arange(num_tasks, device=prelogits.device) * num_labels) \
+            .unsqueeze(1).repeat(1, batch_size)
+        sample_idx = torch.arange(batch_size, device=prelogits.device)
+        for task_ids in candidates:
+            means = class_means[task_ids]  # [n, num_labels, dim]
+            if self.query_mode == "cosine":
+                score_over_classes = - F.cosine_similarity(prelogits.unsqueeze(1), means, dim=-1)
+            elif self.query_mode == "euclidean":
+                score_over_classes = torch.linalg.norm(prelogits.unsqueeze(1) - means, dim=-1)
+            else:
+                score_over_classes = mahalanobis(prelogits.unsqueeze(1), means, distribution["cov_inv"], norm=2)
+            # [n, num_labels]
+            score, class_indices = score_over_classes.min(dim=1)
+            scores_over_tasks[task_ids, sample_idx] = score
+            class_indices_over_tasks[task_ids, sample_idx] = class_indices + task_ids * num_labels
+        _, indices = torch.min(scores_over_tasks, dim=0)
+
+        return indices, scores_over_tasks, class_indices_over_tasks
+
+    def run_expert(self, e_id, input_ids, rows=None, use_view=False, **kwargs):
+        """
+        Encode the batch with expert e_id (-1: origin bert) and score it against the expert's statistics.
+        If rows is given, only these samples are encoded; the others get infinite scores and zero logits.
+        """
+        batch_size, _ = input_ids.shape
+        num_tasks = self.num_tasks + 1
+        if rows is not None:
+            if rows.numel() == 0:
+                return (
+                    torch.full((batch_size, num_tasks), float('inf'), device=self.device),
+                    torch.zeros(batch_size, num_tasks, dtype=torch.long, device=self.device),
+                    torch.zeros(batch_size, self.class_per_task, device=self.device),
+                )
+            kwargs = {
+                k: v[rows] if isinstance(v, torch.Tensor) and v.dim() > 0 and v.shape[0] == batch_size else v
+                for k, v in kwargs.items()
+            }
+            input_ids = input_ids[rows]
+
+        extract_mode = None
+        if e_id == -1:
+            indices = None
+            use_origin = True
+            extract_mode = "entity"
+        elif e_id == 0:
+            indices = None
+            use_origin = False
+        else:
+            indices = [e_id] * input_ids.shape[0]
+            use_origin = False
+        kwargs.pop("extract_mode", None)
+        if e_id == -1:
+            # the origin bert encodes the sentence without markers with its own weights
+            kwargs.pop("trunk_states", None)
+        hidden_states = self.feature_extractor(
+            input_ids=input_ids if e_id != -1 else kwargs["input_ids_without_marker"],
+            indices=indices,
+            use_origin=use_origin,
+            extract_mode=extract_mode,
+            use_view=use_view,
+            **kwargs
+        )
+        if self.profile_routing:
+            if hidden_states.is_cuda:
+                torch.cuda.synchronize(hidden_states.device)
+            start_time = time.perf_counter()
+        _, scores_over_tasks, scores_over_classes = self.get_prompt_indices(hidden_states, expert_id=e_id)
+        if self.profile_routing:
+            if hidden_states.is_cuda:
+                torch.cuda.synchronize(hidden_states.device)
+            # appended instead of summed, the experts may run in concurrent threads
+            self.routing_times.append(time.perf_counter() - start_time)
+        scores_over_tasks = scores_over_tasks.transpose(-1, -2)
+        scores_over_classes = scores_over_classes.transpose(-1, -2)
+        logits = None
+        if e_id != -1:
+            scores_over_tasks[:, :e_id] = float('inf')  # no seen task
+            logits = self.classifier[e_id](hidden_states)[:, :self.class_per_task]
+
+        if rows is not None:
+            full_scores_over_tasks = torch.full((batch_size, num_tasks), float('inf'), device=self.device)
+            full_scores_over_tasks[rows] = scores_over_tasks
+            full_scores_over_classes = torch.zeros(batch_size, num_tasks, dtype=torch.long, device=self.device)
+            full_scores_over_classes[rows] = scores_over_classes
+            scores_over_tasks, scores_over_classes = full_scores_over_tasks, full_scores_over_classes
+            if logits is not None:
+                full_logits = torch.zeros(batch_size, logits.shape[-1], device=self.device)
+                full_logits[rows] = logits
+                logits = full_logits
+        return scores_over_tasks, scores_over_classes, logits
+
+    def run_experts(self, expert_ids, input_ids, expert_rows, **kwargs):
+        """
+        Run several experts on the same batch, concurrently if expert_workers > 0. Every worker limits its
+        intra-op threads and encodes with its own adapter view, so peft_bert.set_adapter is never raced.
+        """
+        for e_id in expert_ids:
+            rows = expert_rows[e_id]
+            self.num_expert_passes += input_ids.shape[0] if rows is None else rows.numel()
+        used = [e_id for e_id in expert_ids if expert_rows[e_id] is None or expert_rows[e_id].numel() > 0]
+        if self.expert_workers <= 0 or len(expert_ids) == 1:
+            outputs = {}
+            for e_id in expert_ids:
+                if e_id in used:
+                    self.use_expert(e_id)
+                outputs[e_id] = self.run_expert(e_id, input_ids, rows=expert_rows[e_id], **kwargs)
+            return outputs
+
+        # the experts run at the same time, all of them stay resident until they finished
+        for e_id in used:
+            self.use_expert(e_id, evict=False)
+
+        if self.expert_executor is None:
+            self.expert_executor = ThreadPoolExecutor(max_workers=self.expert_workers)
+        use_view = self.peft_type == "lora"
+        if use_view:
+            # create missing views before the workers start
+            for e_id in expert_ids:
+                if e_id > 0:
+                    self.feature_extractor.get_adapter_view(e_id)
+
+        def run_in_worker(e_id):
+            # only a per-thread limit with the openmp backend (torch.__config__.parallel_info()), with the native
+            # backend it sets the size of the one intra-op pool that all workers share
+            torch.set_num_threads(self.expert_intra_op_threads)
+            with torch.no_grad():
+                return self.run_expert(e_id, input_ids, rows=expert_rows[e_id], use_view=use_view, **kwargs)
+
+        num_threads = torch.get_num_threads()
+        try:
+            futures = {e_id: self.expert_executor.submit(run_in_worker, e_id) for e_id in expert_ids}
+            return {e_id: future.result() for e_id, future in futures.items()}
+        finally:
+            torch.set_num_threads(num_threads)
+            if self.expert_store is not None:
+                self.expert_store.evict_to_budget()
+
+    def encode_descriptions(self, description_ids, bank_keys=()):
+        """
+        Encode the description ids of a training batch (key -> (batch, len_k)) with one forward over the unique
+        descriptions. Samples of the same label carry the same descriptions, the embeddings are scattered back
+        to every sample and key. Descriptions that only appear under bank_keys are taken from the description
+        bank while their entry is fresh, these embeddings are detached.
+        """
+        if len(description_ids) == 0:
+            return {}
+        max_length = max(v.size(1) for v in description_ids.values())
+        all_ids = torch.cat([F.pad(v, (0, max_length - v.size(1))) for v in description_ids.values()])
+        unique_ids, inverse = torch.unique(all_ids, dim=0, return_inverse=True)
+        # one copy to the host per step, the lengths and the bank keys are read from it
+        host_ids = unique_ids.cpu().numpy()
+        lengths = (host_ids != 0).sum(axis=1).tolist()
+
+        cached = {}
+        bank_rows = []
+        if self.description_bank is not None and len(bank_keys) > 0:
+            from_bank = torch.cat([
+                torch.full((v.size(0),), k in bank_keys, dtype=torch.bool, device=all_ids.device)
+                for k, v in description_ids.items()
+            ])
+            used_outside_bank = torch.zeros(unique_ids.size(0), dtype=torch.bool, device=all_ids.device)
+            used_outside_bank[inverse[~from_bank]] = True
+            for row in (~used_outside_bank).nonzero().squeeze(-1).tolist():
+                key = host_ids[row, :lengths[row]].tobytes()
+                entry = self.description_bank.get(key)
+                if entry is not None and self.description_step - entry[1] < self.description_bank_refresh:
+                    cached[row] = entry[0]
+                else:
+                    bank_rows.append((row, key))
+            self.description_bank_hits += len(cached)
+            self.description_bank_misses += len(bank_rows)
+
+        encode_rows = [row for row in range(unique_ids.size(0)) if row not in cached]
+        encoded = None
+        if len(encode_rows) > 0:
+            encode_ids = unique_ids[encode_rows]
+            # drop the columns that are padding in every encoded description
+            encode_ids = encode_ids[:, :max(lengths[row] for row in encode_rows)]
+            encoded = self.feature_extractor(
+                input_ids=encode_ids,
+                attention_mask=(encode_ids != 0),
+                indices=torch.full((encode_ids.size(0),), self.num_tasks, dtype=torch.long, device=encode_ids.device),
+                extract_mode="cls",
+            )
+        if len(cached) == 0:
+            unique_hidden_states = encoded
+        else:
+            cached_rows = list(cached.keys())
+            unique_hidden_states = torch.stack([cached[row] for row in cached_rows])
+            unique_hidden_states = unique_hidden_states.new_zeros(unique_ids.size(0), unique_hidden_states.size(-1)) \
+                .index_put((torch.tensor(cached_rows, device=all_ids.device),), unique_hidden_states)
+            if encoded is not None:
+                unique_hidden_states = unique_hidden_states.index_put(
+                    (torch.tensor(encode_rows, device=all_ids.device),), encoded
+                )
+
+        for row, key in bank_rows:
+            embedding = unique_hidden_states[row].detach()
+            entry = self.description_bank.get(key)
+            if entry is not None and self.description_bank_momentum > 0:
+                embedding = self.description_bank_momentum * entry[0] + (1 - self.description_bank_momentum) * embedding
+                embedding = nn.functional.normalize(embedding, p=2, dim=-1)
+            self.description_bank[key] = (embedding, self.description_step)
+
+        hidden_states = unique_hidden_states[inverse].split([v.size(0) for v in description_ids.values()])
+        return dict(zip(description_ids.keys(), hidden_states))
+
     def forward(self, input_ids, attention_mask=None, labels=None, oracle=False, **kwargs):
 
         batch_size, _ = input_ids.shape
@@ -202,9 +812,11 @@ class EoE(nn.Module):
             attention_mask = input_ids != 0
 
         if self.training:
+            self.use_expert(self.num_tasks, write=True)
             indices = torch.LongTensor([self.num_tasks] * batch_size).to(self.device)
         else:
             if "return_hidden_states" in kwargs and kwargs["return_hidden_states"]:
+                self.use_expert(kwargs["task_idx"])
                 # input task idx 0-9 -1:bert
                 if kwargs["task_idx"] == -1:  # origin bert
                     indices = None
@@ -226,40 +838,41 @@ class EoE(nn.Module):
                     del kwargs["extract_mode"]
                 return hidden_states
 
-            all_score_over_task = []
-            all_score_over_class = []
-            all_logits = []
-            for e_id in range(-1, self.num_tasks + 1):
-                if e_id == -1:
-                    indices = None
-                    use_origin = True
-                    kwargs.update({"extract_mode": "entity"})
-                elif e_id == 0:
-                    indices = None
-                    use_origin = False
-                else:
-                    indices = [e_id] * batch_size
-                    use_origin = False
-                hidden_states = self.feature_extractor(
-                    input_ids=input_ids if e_id != -1 else kwargs["input_ids_without_marker"],
-                    indices=indices,
-                    use_origin=use_origin,
-                    **kwargs
-                )
-                if "extract_mode" in kwargs:
-                    del kwargs["extract_mode"]
-                _, scores_over_tasks, scores_over_classes = self.get_prompt_indices(hidden_states, expert_id=e_id)
-                scores_over_tasks = scores_over_tasks.transpose(-1, -2)
-                scores_over_classes = scores_over_classes.transpose(-1, -2)
-                if e_id != -1:
-                    scores_over_tasks[:, :e_id] = float('inf')  # no seen task
-                    logits = self.classifier[e_id](hidden_states)[:, :self.class_per_task]
-                    all_logits.append(logits)
-                all_score_over_task.append(scores_over_tasks)
-                all_score_over_class.append(scores_over_classes)
+            # budgeted mode: the origin bert scores all tasks and only the adapters of its top-k tasks
+            # (plus the top-1 task of the default expert) are executed for each sample
+            budget = self.expert_topk > 0 and not oracle
+            num_candidates = self.num_tasks + 1
+            expert_ids = list(range(-1, self.num_tasks + 1))
+            stages = [expert_ids[:2], expert_ids[2:]] if budget else [expert_ids]
+            candidate_mask = None
+            expert_outputs = {}
+            if self.feature_extractor.trunk_layers > 0:
+                # the frozen lower layers are computed once and shared by all experts except the origin bert
+                kwargs["trunk_states"] = self.feature_extractor.encode_trunk(input_ids, attention_mask)
+            for stage in stages:
+                expert_rows = {
+                    e_id: candidate_mask[:, e_id].nonzero().squeeze(-1) if candidate_mask is not None else None
+                    for e_id in stage
+                }
+                expert_outputs.update(self.run_experts(stage, input_ids, expert_rows, **kwargs))
+                if budget and candidate_mask is None:
+                    top_k = min(self.expert_topk, num_candidates)
+                    top_tasks = torch.topk(expert_outputs[-1][0], k=top_k, dim=-1, largest=False)[1]
+                    candidate_mask = torch.zeros(batch_size, num_candidates, dtype=torch.bool, device=self.device)
+                    sample_idx = torch.arange(batch_size, device=self.device)
+                    candidate_mask[sample_idx.unsqueeze(1), top_tasks] = True
+                    candidate_mask[sample_idx, expert_outputs[0][0].argmin(dim=-1)] = True
+            all_score_over_task = [expert_outputs[e_id][0] for e_id in expert_ids]
+            all_score_over_class = [expert_outputs[e_id][1] for e_id in expert_ids]
+            all_logits = [expert_outputs[e_id][2] for e_id in expert_ids[1:]]
             all_score_over_task = torch.stack(all_score_over_task, dim=1)  # (batch, expert_num, task_num)
             all_score_over_class = torch.stack(all_score_over_class, dim=1)  # (batch, expert_num, task_num)
             all_logits = torch.stack(all_logits, dim=1)
+            executed = [[True] * (self.num_tasks + 2) for _ in range(batch_size)]
+            if candidate_mask is not None:
+                # tasks whose expert was skipped can not be predicted
+                all_score_over_task = all_score_over_task.masked_fill(~candidate_mask.unsqueeze(1), float('inf'))
+                executed = torch.cat([candidate_mask.new_ones(batch_size, 2), candidate_mask[:, 1:]], dim=1).tolist()
             indices = []
             # expert0_score_over_task = all_score_over_task[:, 0, :]  # (batch, task_num)
             expert_values, expert_indices = torch.topk(all_score_over_task, dim=-1, k=all_score_over_task.shape[-1],
@@ -280,7 +893,7 @@ class EoE(nn.Module):
                 if bert_indices[0] != task_indices[0] and cur_min_expert > 1:
                     cur_ans = []
                     for j in range(0, cur_min_expert + 1):
-                        if j <= self.max_expert:  # self.max_expert==1 --> default expert
+                        if j <= self.max_expert and executed[i][j]:  # self.max_expert==1 --> default expert
                             for k in expert_indices[i][j]:
                                 if k >= min_task:
                                     cur_ans.append(k)
@@ -321,7 +934,7 @@ class EoE(nn.Module):
         if self.training:
             offset_label = labels - self.num_old_labels
             loss = F.cross_entropy(logits, offset_label)
-            loggerdb.log({f"train/loss_cross_entropy_{self.num_tasks}": loss.item()})
+            cross_entropy_loss = loss
             
             
             # Add thêm ====================================================================================
@@ -330,47 +943,27 @@ class EoE(nn.Module):
             old_description_ids_list = {k: v for k, v in kwargs.items() if k.startswith('old_description_ids_')}
             description_ids_list = {k: v for k, v in kwargs.items() if k.startswith('description_ids_')}
             
-            old_description_hidden_states_dict = {}
-            for kk, vv in old_description_ids_list.items():
-                old_description_hidden_states_dict[kk] = self.feature_extractor(
-                    input_ids=vv,
-                    attention_mask=(vv != 0),
-                    indices=indices,
-                    extract_mode="cls",
-                    **kwargs
-                )
-                            
-            total_log_term = torch.zeros(1, device=self.device)
-            for k, v in description_ids_list.items():
-                # print("2")
-                description_hidden_states = self.feature_extractor(
-                    input_ids=v,
-                    attention_mask=(v != 0),
-                    indices=indices,
-                    extract_mode="cls",
-                    **kwargs
+            description_hidden_states_dict = self.encode_descriptions(
+                {**old_description_ids_list, **description_ids_list}, bank_keys=old_description_ids_list.keys()
+            )
+            self.description_step += 1
+            old_description_hidden_states_dict = {k: description_hidden_states_dict[k] for k in old_description_ids_list}
+
+            cr_loss = torch.zeros((), device=self.device)
+            if len(old_description_hidden_states_dict) > 0 and len(description_ids_list) > 0:
+                cr_loss = description_contrastive_loss(
+                    anchor_hidden_states,
+                    torch.stack(list(old_description_hidden_states_dict.values()), dim=1),
+                    torch.stack([description_hidden_states_dict[k] for k in description_ids_list], dim=1),
+                    self.tau,
                 )
-                
-                numerator_list = []
-                denominator_list = []
-                for kk, old_description_hidden_states in old_description_hidden_states_dict.items():
-                    numerator_list.append(torch.exp((anchor_hidden_states * old_description_hidden_states).sum(dim=1, keepdim=True) / self.tau))
-                    denominator_list.append(torch.exp((anchor_hidden_states * old_description_hidden_states).sum(dim=1, keepdim=True) / self.tau))
-                                
-                denominator_list.append(torch.exp((anchor_hidden_states * description_hidden_states).sum(dim=1, keepdim=True) / self.tau))
-                denominator = torch.sum(torch.stack(denominator_list), dim=0)
-                # Compute log term
-                log_term = torch.zeros(batch_size, 1, device=self.device)
-                for numerator in numerator_list:
-                    log_term += torch.log(numerator / denominator)
-
-                total_log_term += (log_term.mean()/len(numerator_list))
-            # print("----CR Loss-------")
-            # print((total_log_term / len(description_ids_list)).item())
-            loss += 0.5 * (total_log_term / len(description_ids_list)).squeeze(0)
-
-            loggerdb.log({f"train/cr_loss_{self.num_tasks}": (total_log_term / len(description_ids_list)).item()})
-            loggerdb.log({f"train/total_loss_{self.num_tasks}": loss.item()})
+            loss = loss + 0.5 * cr_loss
+
+            log_metrics({
+                f"train/loss_cross_entropy_{self.num_tasks}": cross_entropy_loss,
+                f"train/cr_loss_{self.num_tasks}": cr_loss,
+                f"train/total_loss_{self.num_tasks}": loss,
+            })
             
             # Add thêm ====================================================================================
 
@@ -385,6 +978,21 @@ class EoE(nn.Module):
         )
 
 
+def description_contrastive_loss(anchor_hidden_states, old_description_hidden_states, description_hidden_states, tau):
+    """
+    Contrastive term over the similarities (batch, old) of the anchors to the old descriptions
+    (batch, old, dim) and (batch, desc) to the descriptions of their label (batch, desc, dim), averaged over
+    the old descriptions, descriptions and samples: s_old / tau - log(sum_old exp(s_old / tau) + exp(s_desc / tau))
+    """
+    old_scores = torch.einsum("bd,bjd->bj", anchor_hidden_states, old_description_hidden_states) / tau
+    description_scores = torch.einsum("bd,bkd->bk", anchor_hidden_states, description_hidden_states) / tau
+    all_scores = torch.cat([
+        old_scores.unsqueeze(1).expand(-1, description_scores.size(1), -1),
+        description_scores.unsqueeze(-1),
+    ], dim=-1)  # (batch, desc, old + 1)
+    return (old_scores.mean(dim=1, keepdim=True) - torch.logsumexp(all_scores, dim=-1)).mean()
+
+
 @dataclass
 class ExpertOutput:
     loss: Optional[torch.FloatTensor] = None
@@ -0,0 +1,173 @@
+import json
+import os
+import tempfile
+import time
+from collections import OrderedDict
+
+from safetensors import safe_open
+from safetensors.torch import save_file
+
+
+class ExpertStore:
+    """
+    Keep at most budget experts of an EoE model resident. An expert is its lora adapter, its classifier head
+    and its routing statistics (expert -1 has only statistics). In training the least recently used expert is
+    evicted. In evaluation every batch runs all experts in the same order, where LRU would evict each expert
+    just before it is used again, so the most recently paged in expert is evicted instead: the experts paged
+    in first stay resident over the sweeps and only the last slot cycles. An expert is evicted to its own
+    safetensors file, which is only rewritten if the expert changed since it was last written, and its memory
+    is released. It is read back from the mapped file when it is used again. The files live in a temporary
+    directory under store_dir that is removed by close or at exit.
+    """
+
+    def __init__(self, model, store_dir, budget):
+        self.model = model
+        self.budget = budget
+        os.makedirs(store_dir, exist_ok=True)
+        self.temporary_dir = tempfile.TemporaryDirectory(prefix="experts-", dir=store_dir)
+        self.store_dir = self.temporary_dir.name
+        # expert id -> None, from the least to the most recently used (paged in, in evaluation)
+        self.resident = OrderedDict()
+        # experts changed since their file was written
+        self.dirty = set()
+        # experts touched since the last eviction, used together and evicted by it only after the others
+        self.group = set()
+        self.clear()
+        self.reset_stats()
+
+    def close(self):
+        """
+        Delete the store files, the paged out experts are lost.
+        """
+        self.temporary_dir.cleanup()
+        self.resident = OrderedDict()
+        self.dirty = set()
+        self.group = set()
+
+    def reset_stats(self):
+        """
+        Reset the counters, e.g. before an evaluation so that the training touches are not counted.
+        """
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.writes = 0
+        self.page_in_time = 0.0
+
+    def clear(self):
+        """
+        Forget the paged out experts, e.g. when the model state is replaced.
+        """
+        for name in os.listdir(self.store_dir):
+            if name.startswith("expert"):
+                os.remove(os.path.join(self.store_dir, name))
+        self.resident = OrderedDict()
+        self.dirty = set()
+        self.group = set()
+
+    def path(self, e_id):
+        return os.path.join(self.store_dir, f"expert{e_id}.safetensors")
+
+    def touch(self, e_id, write=False, evict=True):
+        """
+        Make e_id resident and, in training, the most recently used expert. write marks it as changed,
+        evict=False keeps the other experts resident until the next touch, for a group of experts used together.
+        """
+        if e_id in self.resident:
+            self.hits += 1
+            if self.model.training:
+                self.resident.move_to_end(e_id)
+        else:
+            if os.path.exists(self.path(e_id)):
+                self.misses += 1
+                self.page_in(e_id)
+            # an expert without a file is new and still resident
+            self.resident[e_id] = None
+        if write:
+            self.dirty.add(e_id)
+        self.group.add(e_id)
+        if evict:
+            self.evict_to_budget()
+
+    def evict_to_budget(self):
+        order = list(self.resident) if self.model.training else list(reversed(self.resident))
+        candidates = [e_id for e_id in order if e_id not in self.group] + [e_id for e_id in order if e_id in self.group]
+        for e_id in candidates[:max(len(self.resident) - self.budget, 0)]:
+            self.evict(e_id)
+        self.group = set()
+
+    def paged_out(self, e_id):
+        return e_id not in self.resident and os.path.exists(self.path(e_id))
+
+    def evict(self, e_id):
+        del self.resident[e_id]
+        self.evictions += 1
+        model = self.model
+        expert_id = model.shift_expert_id(e_id)
+        adapter_parameters = model.expert_adapter_parameters(e_id)
+        if e_id in self.dirty or not os.path.exists(self.path(e_id)):
+            tensors = {f"adapter.{name}": param.data for name, param in adapter_parameters.items()}
+            if e_id >= 0:
+                for name, param in model.classifier[e_id].named_parameters():
+                    tensors[f"classifier.{name}"] = param.data
+            distribution = model.expert_distribution[expert_id]
+            for field, value in distribution.items():
+                if isinstance(value, list):
+                    for t, v in enumerate(value):
+                        tensors[f"distribution.{field}.{t}"] = v
+                elif value is not None:
+                    tensors[f"distribution.{field}"] = value
+            metadata = {"num_tasks": len(distribution["class_mean"])}
+            tensors = {k: v.detach().cpu().contiguous() for k, v in tensors.items()}
+            save_file(tensors, self.path(e_id) + ".tmp", metadata={"format": "pt", "metadata": json.dumps(metadata)})
+            os.replace(self.path(e_id) + ".tmp", self.path(e_id))
+            self.dirty.discard(e_id)
+            self.writes += 1
+        # release the memory, the parameter objects stay in place for the optimizer and the adapter views
+        for param in adapter_parameters.values():
+            param.data = param.data.new_empty(0)
+        if e_id >= 0:
+            for param in model.classifier[e_id].parameters():
+                param.data = param.data.new_empty(0)
+        model.expert_distribution[expert_id] = None
+
+    def read(self, e_id):
+        """
+        The adapter parameters (by their peft_bert names), the classifier parameters and the statistics of an
+        expert from its file, as host tensors mapped from the file. The expert doesn't become resident.
+        """
+        with safe_open(self.path(e_id), framework="pt", device="cpu") as file:
+            metadata = json.loads(file.metadata()["metadata"])
+            names = set(file.keys())
+            adapter = {
+                name[len("adapter."):]: file.get_tensor(name) for name in names if name.startswith("adapter.")
+            }
+            classifier = {
+                name[len("classifier."):]: file.get_tensor(name) for name in names if name.startswith("classifier.")
+            }
+            distribution = self.model.distribution_from_tensors({
+                name[len("distribution."):]: file.get_tensor(name) for name in names if name.startswith("distribution.")
+            }, metadata["num_tasks"])
+        return adapter, classifier, distribution
+
+    def page_in(self, e_id):
+        start_time = time.perf_counter()
+        model = self.model
+        adapter, classifier, distribution = self.read(e_id)
+        for name, param in model.expert_adapter_parameters(e_id).items():
+            param.data = adapter[name].to(model.device)
+        if e_id >= 0:
+            for name, param in model.classifier[e_id].named_parameters():
+                param.data = classifier[name].to(model.device)
+        model.expert_distribution[model.shift_expert_id(e_id)] = model.distribution_to_device(distribution)
+        self.page_in_time += time.perf_counter() - start_time
+
+    def stats(self):
+        return {
+            "resident": len(self.resident),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "writes": self.writes,
+            "page_in_ms": 1000 * self.page_in_time / max(self.misses, 1),
+        }
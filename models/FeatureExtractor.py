@@ -1,14 +1,42 @@
 import copy
 import logging
+import math
+import os
 
 import torch
 import torch.nn as nn
-from peft import get_peft_model, LoraConfig, TaskType, PeftModel
+from peft import get_peft_model, get_peft_model_state_dict, set_peft_model_state_dict, LoraConfig, TaskType
+from peft.utils import SAFETENSORS_WEIGHTS_NAME
 from transformers import BertModel
 
+from utils import TrunkActivationCache, save_checkpoint, safetensors_save
+
 logger = logging.getLogger(__name__)
 
 
+def copy_with_shared_weights(module):
+    """
+    Copy the module structure but share its parameters and buffers with the original module.
+    """
+    memo = {id(tensor): tensor for tensor in list(module.parameters()) + list(module.buffers())}
+    return copy.deepcopy(module, memo)
+
+
+def pool_entity_spans(last_hidden_states, subject_st, subject_ed, object_st, object_ed):
+    """
+    Average the hidden states over the subject and the object span (inclusive ends) of every sample and
+    concatenate them, (batch, seq_len, dim) -> (batch, 2 * dim).
+    """
+    span_st = torch.stack([subject_st, object_st], dim=1)  # (batch, 2)
+    span_ed = torch.stack([subject_ed, object_ed], dim=1)
+    positions = torch.arange(last_hidden_states.size(1), device=last_hidden_states.device)
+    # (batch, 2, seq_len) masks of the subject and object spans, averaged with one batched matmul
+    span_mask = (positions >= span_st.unsqueeze(-1)) & (positions <= span_ed.unsqueeze(-1))
+    span_mask = span_mask.to(last_hidden_states.dtype)
+    hidden_states = torch.bmm(span_mask, last_hidden_states) / span_mask.sum(dim=-1, keepdim=True)
+    return hidden_states.view(last_hidden_states.size(0), -1)
+
+
 class PeftFeatureExtractor(nn.Module):
     """
     Extracting feature from the pretrained language model with little trainable parameters (peft)
@@ -27,10 +55,17 @@ class PeftFeatureExtractor(nn.Module):
 
         self.origin_bert = None
         self.peft_bert = None
+        # adapter name -> peft model sharing the weights of peft_bert with that adapter selected
+        self.adapter_views = {}
         self.peft_type = config.peft_type if hasattr(config, "peft_type") else None
         self.peft_init = config.peft_init if hasattr(config, "peft_init") else None
 
-        self.prompts = nn.ParameterList()
+        # prompt bank: the prompts of finished tasks are stacked in a frozen buffer [num_tasks, pre_seq_len, dim]
+        # and only the prompt of the current task is a trainable parameter
+        self.register_buffer("frozen_prompts", None)
+        self.register_parameter("prompt", None)
+        # task id -> past key values of a frozen prefix, precomputed for evaluation
+        self.past_key_values_cache = {}
         self.pre_seq_len = config.pre_seq_len if hasattr(config, "pre_seq_len") else None
         self.n_layer = self.bert.config.num_hidden_layers
         self.n_head = self.bert.config.num_attention_heads
@@ -38,6 +73,33 @@ class PeftFeatureExtractor(nn.Module):
         self.hidden_size = self.bert.config.hidden_size
         self.dropout = nn.Dropout(self.bert.config.hidden_dropout_prob)
         self.output_layer = nn.Linear(self.hidden_size, self.hidden_size*2)
+        # inject adapters only into the top adapter_layers layers (-1: all layers), the frozen lower
+        # layers form a trunk that is shared by the first-task model and all adapters
+        self.adapter_layers = config.adapter_layers if hasattr(config, "adapter_layers") else -1
+        self.trunk_layers = 0
+        if 0 < self.adapter_layers < self.n_layer:
+            self.trunk_layers = self.n_layer - self.adapter_layers
+        # train the frozen trunk without dropout, its states are then the same in every epoch and can be cached
+        self.trunk_dropout = config.trunk_dropout if hasattr(config, "trunk_dropout") else True
+        if not self.trunk_dropout and not config.frozen:
+            raise ValueError("trunk_dropout=false runs the trunk without gradients, it needs frozen=true")
+        # cache the frozen trunk states of training sequences across epochs
+        self.trunk_cache = None
+        if hasattr(config, "trunk_cache") and config.trunk_cache and self.trunk_layers > 0:
+            if self.trunk_dropout:
+                raise ValueError("the trunk cache holds the states without dropout, set trunk_dropout=false")
+            cache_dir = config.trunk_cache_dir if hasattr(config, "trunk_cache_dir") else "./cache"
+            max_mb = config.trunk_cache_max_mb if hasattr(config, "trunk_cache_max_mb") else -1
+            self.trunk_cache = TrunkActivationCache(
+                os.path.join(cache_dir, f"{self.dataset}-trunk-{os.getpid()}.bin"), self.hidden_size,
+                max_bytes=max_mb * 2 ** 20 if max_mb > 0 else None,
+            )
+            logger.info(f"cache the outputs of the first {self.trunk_layers} layers in {self.trunk_cache.path}")
+
+        # with entity_marker extraction, compute the queries and feed-forward of the last layer only at the
+        # marker positions, the keys and values still cover the full sequence
+        self.marker_only_last_layer = config.marker_only_last_layer \
+            if hasattr(config, "marker_only_last_layer") else False
 
         if config.task_name == "RelationExtraction":
             self.extract_mode = "entity_marker"
@@ -48,6 +110,7 @@ class PeftFeatureExtractor(nn.Module):
             logger.info("freeze the parameters of the pretrained language model.")
             for param in self.bert.parameters():
                 param.requires_grad = False
+            # the origin bert keeps the pretrained weights, self.bert is later overwritten by the first-task expert
             self.origin_bert = copy.deepcopy(self.bert)
             for param in self.origin_bert.parameters():
                 param.requires_grad = False
@@ -58,42 +121,102 @@ class PeftFeatureExtractor(nn.Module):
             peft_config = LoraConfig(
                 task_type=TaskType.FEATURE_EXTRACTION, inference_mode=False, r=8, lora_alpha=16, lora_dropout=0.1,
                 target_modules=["key", "query", "value"],
+                layers_to_transform=list(range(self.trunk_layers, self.n_layer)) if self.trunk_layers > 0 else None,
             )
             adapter_name = f"task-{task_id}"
-            self.peft_bert = get_peft_model(copy.deepcopy(self.bert), peft_config, adapter_name)
+            if self.peft_bert is None:
+                # the adapters are injected into a copy of the module structure, the frozen weights stay shared
+                self.peft_bert = get_peft_model(copy_with_shared_weights(self.bert), peft_config, adapter_name)
+            else:
+                # earlier adapters stay resident and frozen, only the new adapter is trainable
+                self.peft_bert.add_adapter(adapter_name, peft_config)
+                self.peft_bert.set_adapter(adapter_name)
+            self.adapter_views = {}
             self.peft_bert.print_trainable_parameters()
             logger.info(f"inject {self.peft_type} into the pretrain model, name is {adapter_name}")
-        elif self.peft_type == "prefix":
-            for param in self.prompts.parameters():
-                param.requires_grad = False
-            if len(self.prompts) > 0 and self.peft_init == "last":
-                new_prompt = self.prompts[-1].data.clone()
-            else:
+            logger.info(f"resident model weights: {self.resident_weight_bytes() / 2 ** 20:.1f} MB")
+        elif self.peft_type in ["prefix", "prompt"]:
+            if self.peft_type == "prefix" and self.prompt is not None and self.peft_init == "last":
+                new_prompt = self.prompt.data.clone()
+            elif self.peft_type == "prefix":
                 new_prompt = torch.randn(
                     self.pre_seq_len, self.n_layer * self.hidden_size * 2, device=self.device
                 )
-            self.prompts.append(nn.Parameter(new_prompt, requires_grad=True))
-            logger.info(f"inject {self.peft_type} into the pretrain model")
-        elif self.peft_type == "prompt":
-            for param in self.prompts.parameters():
-                param.requires_grad = False
-            new_prompt = torch.randn(self.pre_seq_len, self.hidden_size, device=self.device)
-            self.prompts.append(nn.Parameter(new_prompt, requires_grad=True))
+            else:
+                new_prompt = torch.randn(self.pre_seq_len, self.hidden_size, device=self.device)
+            if self.prompt is not None:
+                # freeze the prompt of the previous task into the bank
+                prompt = self.prompt.data.unsqueeze(0)
+                self.frozen_prompts = prompt if self.frozen_prompts is None else \
+                    torch.cat([self.frozen_prompts, prompt], dim=0)
+            self.prompt = nn.Parameter(new_prompt, requires_grad=True)
+            self.past_key_values_cache = {}
             logger.info(f"inject {self.peft_type} into the pretrain model")
         else:
             raise NotImplementedError
 
-    def save_and_load_all_adapters(self, task_id, save_dir, save=True):
+    def register_adapter(self, task_id, save_dir, save=True):
+        """
+        Persist only the adapter of task_id and freeze it in place, the earlier adapters are kept resident.
+        """
         if self.peft_type == "lora":
+            adapter_name = f"task-{task_id}"
             if save:
-                self.peft_bert.save_pretrained(save_dir)
-            self.peft_bert = PeftModel.from_pretrained(
-                copy.deepcopy(self.bert),
-                f"{save_dir}/task-0",
-                adapter_name="task-0"
-            )
-            for i in range(1, task_id + 1):
-                self.peft_bert.load_adapter(f"{save_dir}/task-{i}", adapter_name=f"task-{i}")
+                self.save_adapter(adapter_name, save_dir)
+            for name, param in self.peft_bert.named_parameters():
+                if f".{adapter_name}." in name:
+                    param.requires_grad = False
+
+    def save_adapter(self, adapter_name, save_dir):
+        """
+        Save an adapter in the layout of PeftModel.save_pretrained, the weights are written by the checkpoint
+        writer thread.
+        """
+        output_dir = os.path.join(save_dir, adapter_name)
+        os.makedirs(output_dir, exist_ok=True)
+        peft_config = copy.deepcopy(self.peft_bert.peft_config[adapter_name])
+        if peft_config.base_model_name_or_path is None:
+            peft_config.base_model_name_or_path = self.peft_bert.base_model.model.__dict__.get("name_or_path", None)
+        peft_config.inference_mode = True
+        peft_config.save_pretrained(output_dir)
+        save_checkpoint(
+            get_peft_model_state_dict(self.peft_bert, adapter_name=adapter_name),
+            os.path.join(output_dir, SAFETENSORS_WEIGHTS_NAME),
+            write=safetensors_save,
+        )
+
+    def load_adapter_state(self, task_id, state_dict):
+        """
+        Copy the weights of an adapter, keyed like get_peft_model_state_dict without the adapter name, into the
+        adapter of task_id in place, the adapter views share them.
+        """
+        if self.peft_type != "lora":
+            raise NotImplementedError
+        set_peft_model_state_dict(self.peft_bert, state_dict, adapter_name=f"task-{task_id}")
+
+    def load_adapter_weights(self, task_id, save_dir):
+        """
+        Load the weights saved by register_adapter into the adapter of task_id, which was added by add_adapter.
+        """
+        if self.peft_type == "lora":
+            adapter_name = f"task-{task_id}"
+            self.peft_bert.load_adapter(f"{save_dir}/{adapter_name}", adapter_name=adapter_name)
+            self.adapter_views = {}
+        else:
+            raise NotImplementedError
+
+    def resident_weight_bytes(self):
+        """
+        Bytes of the distinct parameter and buffer storages held by the backbones, adapters and views.
+        """
+        storages = {}
+        for module in [self.bert, self.origin_bert, self.peft_bert] + list(self.adapter_views.values()):
+            if module is None:
+                continue
+            for tensor in list(module.parameters()) + list(module.buffers()):
+                storage = tensor.untyped_storage()
+                storages[storage.data_ptr()] = storage.nbytes()
+        return sum(storages.values())
 
     def load_adapter(self, task_id):
         if self.peft_type == "lora":
@@ -102,18 +225,228 @@ class PeftFeatureExtractor(nn.Module):
         else:
             raise NotImplementedError
 
+    def get_adapter_view(self, task_id):
+        """
+        Return a view of peft_bert with the adapter of task_id selected, so that several adapters can
+        run at the same time without switching the active adapter of peft_bert.
+        """
+        if self.peft_type != "lora":
+            raise NotImplementedError
+        adapter_name = f"task-{task_id}"
+        if adapter_name not in self.adapter_views:
+            view = copy_with_shared_weights(self.peft_bert)
+            view.set_adapter(adapter_name)
+            self.adapter_views[adapter_name] = view
+        return self.adapter_views[adapter_name]
+
+    def encode_trunk(self, input_ids, attention_mask=None):
+        """
+        Run the embeddings and the frozen lower layers that have no adapter. The result can be passed to
+        forward as trunk_states for the first-task model and every adapter.
+        """
+        if attention_mask is None:
+            attention_mask = input_ids != 0
+        hidden_states = self.bert.embeddings(input_ids=input_ids)
+        extended_attention_mask = self.bert.get_extended_attention_mask(attention_mask, input_ids.size())
+        for layer in self.bert.encoder.layer[:self.trunk_layers]:
+            hidden_states = layer(hidden_states, attention_mask=extended_attention_mask)[0]
+        return hidden_states
+
+    @torch.no_grad()
+    def encode_trunk_without_dropout(self, input_ids, attention_mask):
+        training = self.bert.training
+        self.bert.eval()
+        states = self.encode_trunk(input_ids, attention_mask)
+        self.bert.train(training)
+        return states
+
+    @torch.no_grad()
+    def get_trunk_states(self, input_ids, attention_mask=None):
+        """
+        Trunk states of a (right padded) batch without dropout, served from the trunk cache if there is one.
+        Missing sequences are encoded and added to the cache while it has room, padding positions are filled
+        with zeros.
+        """
+        if attention_mask is None:
+            attention_mask = input_ids != 0
+        if self.trunk_cache is None:
+            return self.encode_trunk_without_dropout(input_ids, attention_mask)
+        batch_size, seq_len = input_ids.size()
+        lengths = attention_mask.sum(dim=1).tolist()
+        ids = input_ids.cpu().numpy()
+        keys = [ids[i, :lengths[i]].tobytes() for i in range(batch_size)]
+
+        positions = torch.arange(seq_len, device=input_ids.device).unsqueeze(0)
+        mask = positions < torch.tensor(lengths, device=input_ids.device).unsqueeze(1)
+        trunk_states = torch.zeros(batch_size, seq_len, self.hidden_size, device=input_ids.device)
+        hit = [key in self.trunk_cache for key in keys]
+        missing = [i for i in range(batch_size) if not hit[i]]
+        if len(missing) > 0:
+            rows = torch.tensor(missing, device=input_ids.device)
+            states = self.encode_trunk_without_dropout(input_ids[rows], attention_mask[rows])
+            trunk_states[rows] = states * mask[rows].unsqueeze(-1)
+            self.trunk_cache.put_many(
+                [keys[i] for i in missing], [states[j, :lengths[i]] for j, i in enumerate(missing)]
+            )
+        if len(missing) < batch_size:
+            # the rows of all cached sequences are read at once and scattered to their non-padding positions
+            hit_mask = mask & torch.tensor(hit, device=input_ids.device).unsqueeze(1)
+            trunk_states[hit_mask] = self.trunk_cache.get_many([key for key, h in zip(keys, hit) if h]) \
+                .to(input_ids.device)
+        return trunk_states
+
+    def reset_trunk_cache(self):
+        if self.trunk_cache is not None:
+            self.trunk_cache.clear()
+
+    def close_trunk_cache(self):
+        # deletes the cache file, later forwards encode the trunk again
+        if self.trunk_cache is not None:
+            self.trunk_cache.close()
+            self.trunk_cache = None
+
+    def encode_layers(self, bert, hidden_states, attention_mask, start_layer=0, marker_positions=None):
+        """
+        Run the encoder layers of bert from start_layer on. With marker_positions (batch, m), the last layer
+        is only evaluated at those positions and the returned hidden states are (batch, m, dim).
+        """
+        extended_attention_mask = bert.get_extended_attention_mask(attention_mask, attention_mask.size())
+        layers = bert.encoder.layer[start_layer:]
+        if marker_positions is not None:
+            layers, last_layer = layers[:-1], layers[-1]
+        for layer in layers:
+            hidden_states = layer(hidden_states, attention_mask=extended_attention_mask)[0]
+        if marker_positions is not None:
+            return self.encode_marker_layer(last_layer, hidden_states, extended_attention_mask, marker_positions), None
+        pooled_output = bert.pooler(hidden_states) if bert.pooler is not None else None
+        return hidden_states, pooled_output
+
+    def encode_marker_layer(self, layer, hidden_states, extended_attention_mask, positions):
+        """
+        Evaluate a BertLayer only at positions (batch, m): the queries, attention output and feed-forward are
+        computed for the selected rows, the keys and values over the full sequence.
+        """
+        self_attention = layer.attention.self
+        batch_size = hidden_states.size(0)
+        idx = torch.arange(batch_size, device=hidden_states.device).unsqueeze(-1)
+        selected = hidden_states[idx, positions]  # (batch, m, dim)
+
+        def split_heads(x):
+            x = x.view(batch_size, -1, self_attention.num_attention_heads, self_attention.attention_head_size)
+            return x.transpose(1, 2)
+
+        query = split_heads(self_attention.query(selected))
+        key = split_heads(self_attention.key(hidden_states))
+        value = split_heads(self_attention.value(hidden_states))
+        attention_scores = torch.matmul(query, key.transpose(-1, -2)) / math.sqrt(self_attention.attention_head_size)
+        attention_scores = attention_scores + extended_attention_mask
+        attention_probs = self_attention.dropout(nn.functional.softmax(attention_scores, dim=-1))
+        context = torch.matmul(attention_probs, value).transpose(1, 2)
+        context = context.reshape(batch_size, -1, self_attention.all_head_size)
+        attention_output = layer.attention.output(context, selected)
+        return layer.output(layer.intermediate(attention_output), attention_output)
+
+    def encode_from_trunk(self, bert, trunk_states, attention_mask, marker_positions=None):
+        return self.encode_layers(bert, trunk_states, attention_mask, self.trunk_layers, marker_positions)
+
+    def encode_with_adapter(
+            self, task_id, input_ids, attention_mask, use_view=False, trunk_states=None, marker_positions=None
+    ):
+        if use_view:
+            peft_bert = self.get_adapter_view(task_id)
+        else:
+            self.load_adapter(task_id)
+            peft_bert = self.peft_bert
+        if trunk_states is not None:
+            return self.encode_from_trunk(peft_bert.base_model.model, trunk_states, attention_mask, marker_positions)
+        if marker_positions is not None:
+            bert = peft_bert.base_model.model
+            return self.encode_layers(bert, bert.embeddings(input_ids=input_ids), attention_mask, 0, marker_positions)
+        outputs = peft_bert(
+            input_ids,
+            attention_mask=attention_mask,
+        )
+        return outputs[0], outputs[1]
+
+    def encode_with_adapters(
+            self, input_ids, attention_mask, indices, use_view=False, trunk_states=None, marker_positions=None
+    ):
+        """
+        Encode a batch whose samples are routed to different adapters. The batch is split into one group per
+        adapter and the outputs of the groups are put back in the original order.
+        """
+        indices = torch.as_tensor(indices).tolist()
+        groups = {}
+        for i, task_id in enumerate(indices):
+            groups.setdefault(task_id, []).append(i)
+        if len(groups) == 1:
+            return self.encode_with_adapter(
+                indices[0], input_ids, attention_mask, use_view, trunk_states, marker_positions
+            )
+
+        all_rows = []
+        all_hidden_states = []
+        all_pooled_outputs = []
+        for task_id, rows in groups.items():
+            rows = torch.tensor(rows, device=input_ids.device)
+            hidden_states, pooled_output = self.encode_with_adapter(
+                task_id,
+                input_ids[rows],
+                attention_mask[rows],
+                use_view,
+                trunk_states[rows] if trunk_states is not None else None,
+                marker_positions[rows] if marker_positions is not None else None,
+            )
+            all_rows.append(rows)
+            all_hidden_states.append(hidden_states)
+            all_pooled_outputs.append(pooled_output)
+        order = torch.cat(all_rows).argsort()
+        hidden_states = torch.cat(all_hidden_states)[order]
+        pooled_output = torch.cat(all_pooled_outputs)[order] if all_pooled_outputs[0] is not None else None
+        return hidden_states, pooled_output
+
+    def get_prompts(self, indices):
+        """
+        Gather the prompts of a batch from the bank with one index op. Samples of the current task get the
+        trainable prompt.
+        """
+        indices = torch.as_tensor(indices, device=self.prompt.device)
+        batch_size = indices.shape[0]
+        num_frozen = self.frozen_prompts.shape[0] if self.frozen_prompts is not None else 0
+        if num_frozen == 0:
+            return self.prompt.unsqueeze(0).expand(batch_size, -1, -1)
+        prompt = self.frozen_prompts[indices.clamp(max=num_frozen - 1)]
+        return torch.where((indices == num_frozen).view(-1, 1, 1), self.prompt.unsqueeze(0), prompt)
+
+    def get_past_key_values(self, prompt):
+        batch_size = prompt.shape[0]
+        past_key_values = prompt.view(batch_size, self.pre_seq_len, self.n_layer * 2, self.n_head, self.n_embd)
+        past_key_values = self.dropout(past_key_values)
+        return past_key_values.permute([2, 0, 3, 1, 4]).split(2)
+
     def get_prompts_by_indices(self, indices, attention_mask):
         batch_size, _ = attention_mask.size()
 
         prompt_attention_mask = torch.ones(batch_size, self.pre_seq_len, dtype=torch.long, device=self.device)
         attention_mask = torch.cat([prompt_attention_mask, attention_mask], dim=1)
 
-        prompt = torch.stack([self.prompts[idx] for idx in indices])
+        num_frozen = self.frozen_prompts.shape[0] if self.frozen_prompts is not None else 0
+        task_ids = set(indices) if isinstance(indices, list) else None
+        if self.peft_type == "prefix" and not self.training and task_ids is not None \
+                and len(task_ids) == 1 and indices[0] < num_frozen:
+            # the layout of a frozen prefix is computed once and shared by the batch
+            task_id = indices[0]
+            if task_id not in self.past_key_values_cache:
+                self.past_key_values_cache[task_id] = self.get_past_key_values(self.frozen_prompts[task_id:task_id + 1])
+            past_key_values = tuple(
+                layer.expand(-1, batch_size, -1, -1, -1) for layer in self.past_key_values_cache[task_id]
+            )
+            return past_key_values, attention_mask, None
+
+        prompt = self.get_prompts(indices)
         past_key_values = None
         if self.peft_type == "prefix":
-            past_key_values = prompt.view(batch_size, self.pre_seq_len, self.n_layer * 2, self.n_head, self.n_embd)
-            past_key_values = self.dropout(past_key_values)
-            past_key_values = past_key_values.permute([2, 0, 3, 1, 4]).split(2)
+            past_key_values = self.get_past_key_values(prompt)
         return past_key_values, attention_mask, prompt
 
     def forward(
@@ -124,6 +457,8 @@ class PeftFeatureExtractor(nn.Module):
             extract_mode=None,
             use_origin=False,
             indices=None,
+            use_view=False,
+            trunk_states=None,
             **kwargs
     ):
         batch_size, _ = input_ids.size()
@@ -131,18 +466,38 @@ class PeftFeatureExtractor(nn.Module):
         if attention_mask is None:
             attention_mask = input_ids != 0
 
-        if use_origin:
-            outputs = self.origin_bert(
-                input_ids,
-                attention_mask=attention_mask,
-            )
-        elif self.peft_type is not None and indices is not None:
-            if self.peft_type == "lora":
-                self.load_adapter(indices[0])
-                outputs = self.peft_bert(
+        if trunk_states is None and not self.trunk_dropout and self.trunk_layers > 0 and self.training \
+                and not use_origin and (indices is None or self.peft_type == "lora"):
+            trunk_states = self.get_trunk_states(input_ids, attention_mask)
+
+        extract_mode = extract_mode if extract_mode is not None else self.extract_mode
+        # (batch, 2) marker positions when the last layer is only computed there, the outputs are then
+        # (batch, 2, dim) instead of the full sequence
+        marker_positions = None
+        if self.marker_only_last_layer and extract_mode == "entity_marker" \
+                and "past_key_values" not in kwargs \
+                and (indices is None or use_origin or self.peft_type == "lora"):
+            marker_positions = torch.stack([kwargs["subject_marker_st"], kwargs["object_marker_st"]], dim=1)
+
+        if trunk_states is not None and not use_origin and indices is None:
+            outputs = self.encode_from_trunk(self.bert, trunk_states, attention_mask, marker_positions)
+        elif use_origin:
+            if marker_positions is not None:
+                outputs = self.encode_layers(
+                    self.origin_bert, self.origin_bert.embeddings(input_ids=input_ids), attention_mask,
+                    marker_positions=marker_positions,
+                )
+            else:
+                outputs = self.origin_bert(
                     input_ids,
                     attention_mask=attention_mask,
                 )
+        elif self.peft_type is not None and indices is not None:
+            if self.peft_type == "lora":
+                outputs = self.encode_with_adapters(
+                    input_ids, attention_mask, indices, use_view=use_view, trunk_states=trunk_states,
+                    marker_positions=marker_positions,
+                )
             elif self.peft_type == "prefix":
                 past_key_values, attention_mask, _ = self.get_prompts_by_indices(indices, attention_mask)
                 outputs = self.bert(
@@ -159,10 +514,15 @@ class PeftFeatureExtractor(nn.Module):
                     inputs_embeds=inputs_embeds,
                     attention_mask=attention_mask,
                 )
-                outputs[0] = outputs[0][:, prompt_len:, :]
+                outputs = (outputs[0][:, prompt_len:, :], outputs[1])
                 attention_mask = attention_mask[:, prompt_len:]
             else:
                 raise NotImplementedError
+        elif marker_positions is not None:
+            outputs = self.encode_layers(
+                self.bert, self.bert.embeddings(input_ids=input_ids), attention_mask,
+                marker_positions=marker_positions,
+            )
         else:
             # only for tuning
             outputs = self.bert(
@@ -171,7 +531,6 @@ class PeftFeatureExtractor(nn.Module):
                 past_key_values=kwargs["past_key_values"] if "past_key_values" in kwargs else None,
             )
 
-        extract_mode = extract_mode if extract_mode is not None else self.extract_mode
         # different feature extraction modes
         if extract_mode == "cls":
             hidden_states = outputs[1]  # (batch, dim)
@@ -187,17 +546,11 @@ class PeftFeatureExtractor(nn.Module):
             idx = torch.arange(last_hidden_states.size(0)).to(last_hidden_states.device)
             hidden_states = last_hidden_states[idx, mask_pos]
         elif extract_mode == "entity":
-            last_hidden_states = outputs[0]
-            subj_st, subj_ed = kwargs["subject_st"], kwargs["subject_ed"]
-            obj_st, obj_ed = kwargs["object_st"], kwargs["object_ed"]
-            hidden_states = []
-            for idx in range(last_hidden_states.size(0)):
-                subj = last_hidden_states[idx][subj_st[idx]: subj_ed[idx] + 1]
-                obj = last_hidden_states[idx][obj_st[idx]: obj_ed[idx] + 1]
-                subj = subj.mean(0)
-                obj = obj.mean(0)
-                hidden_states.append(torch.cat([subj, obj]))
-            hidden_states = torch.stack(hidden_states, dim=0)
+            hidden_states = pool_entity_spans(
+                outputs[0], kwargs["subject_st"], kwargs["subject_ed"], kwargs["object_st"], kwargs["object_ed"]
+            )
+        elif extract_mode == "entity_marker" and marker_positions is not None:
+            hidden_states = outputs[0].reshape(batch_size, -1)  # (batch, 2 * dim)
         elif extract_mode == "entity_marker":
             subject_start_pos = kwargs["subject_marker_st"]
             object_start_pos = kwargs["object_marker_st"]
@@ -1,3 +1,4 @@
 from .FeatureExtractor import PeftFeatureExtractor
 from .ExpertModel import ExpertModel
+from .ExpertStore import ExpertStore
 from .EoE import EoE
@@ -0,0 +1,87 @@
+from types import SimpleNamespace
+
+import pytest
+import torch
+from transformers import BertConfig, BertModel
+
+from models import PeftFeatureExtractor
+
+VOCAB_SIZE = 100
+
+
+@pytest.fixture
+def tiny_bert_path(tmp_path):
+    """
+    Path of a randomly initialized 3-layer bert with hidden size 32.
+    """
+    torch.manual_seed(0)
+    BertModel(BertConfig(
+        vocab_size=VOCAB_SIZE,
+        hidden_size=32,
+        num_hidden_layers=3,
+        num_attention_heads=4,
+        intermediate_size=64,
+        max_position_embeddings=64,
+    )).save_pretrained(tmp_path)
+    return str(tmp_path)
+
+
+@pytest.fixture
+def make_feature_extractor(tiny_bert_path):
+    """
+    Build a PeftFeatureExtractor on the tiny bert with num_adapters lora adapters whose weights are random, so
+    that every adapter gives different features. Returned in eval mode, without dropout.
+    """
+
+    def make(num_adapters=4, **kwargs):
+        config = SimpleNamespace(
+            device="cpu",
+            dataset_name="FewRel",
+            task_name="RelationExtraction",
+            model_name_or_path=tiny_bert_path,
+            additional_special_tokens_len=4,
+            peft_type="lora",
+            frozen=True,
+            adapter_layers=-1,
+            marker_only_last_layer=False,
+        )
+        config.__dict__.update(kwargs)
+        feature_extractor = PeftFeatureExtractor(config)
+        for task_id in range(num_adapters):
+            feature_extractor.add_adapter(task_id)
+        with torch.no_grad():
+            for name, param in feature_extractor.named_parameters():
+                if "lora_" in name:
+                    param.normal_(std=0.2)
+        return feature_extractor.eval()
+
+    return make
+
+
+@pytest.fixture
+def make_batch():
+    """
+    Build a right padded batch of random token ids. The markers and entity spans lie in the first 6 positions,
+    which are never padding.
+    """
+
+    def make(batch_size=8, seq_len=12, seed=0):
+        generator = torch.Generator().manual_seed(seed)
+        lengths = torch.randint(6, seq_len + 1, (batch_size,), generator=generator)
+        lengths[0] = seq_len
+        input_ids = torch.randint(1, VOCAB_SIZE, (batch_size, seq_len), generator=generator)
+        input_ids[torch.arange(seq_len) >= lengths.unsqueeze(1)] = 0
+        subject_st = torch.randint(0, 2, (batch_size,), generator=generator)
+        object_st = torch.randint(3, 5, (batch_size,), generator=generator)
+        return {
+            "input_ids": input_ids,
+            "attention_mask": input_ids != 0,
+            "subject_marker_st": subject_st,
+            "object_marker_st": object_st,
+            "subject_st": subject_st,
+            "subject_ed": subject_st + torch.randint(0, 2, (batch_size,), generator=generator),
+            "object_st": object_st,
+            "object_ed": object_st + torch.randint(0, 2, (batch_size,), generator=generator),
+        }
+
+    return make
@@ -0,0 +1,45 @@
+import pytest
+import torch
+
+INDICES = [1, 3, 1, 2, 0, 3, 2, 1]
+
+
+def per_expert_features(feature_extractor, batch, indices, **kwargs):
+    # one homogeneous pass over the whole batch per expert, each sample keeps the row of its own expert
+    features = {
+        task_id: feature_extractor(indices=[task_id] * len(indices), **batch, **kwargs)
+        for task_id in set(indices)
+    }
+    return torch.stack([features[task_id][i] for i, task_id in enumerate(indices)])
+
+
+@pytest.mark.parametrize("use_view", [False, True])
+@torch.no_grad()
+def test_mixed_batch_matches_per_expert_passes(make_feature_extractor, make_batch, use_view):
+    feature_extractor = make_feature_extractor()
+    batch = make_batch()
+    features = feature_extractor(indices=INDICES, use_view=use_view, **batch)
+    torch.testing.assert_close(features, per_expert_features(feature_extractor, batch, INDICES, use_view=use_view))
+
+
+@torch.no_grad()
+def test_mixed_batch_from_trunk_matches_per_expert_passes(make_feature_extractor, make_batch):
+    feature_extractor = make_feature_extractor(adapter_layers=2)
+    batch = make_batch()
+    trunk_states = feature_extractor.encode_trunk(batch["input_ids"], batch["attention_mask"])
+    features = feature_extractor(indices=INDICES, trunk_states=trunk_states, **batch)
+    torch.testing.assert_close(
+        features, per_expert_features(feature_extractor, batch, INDICES, trunk_states=trunk_states)
+    )
+    # the lower layer has no adapter, so starting from the trunk gives the features of the full forward
+    torch.testing.assert_close(features, feature_extractor(indices=INDICES, **batch))
+
+
+@torch.no_grad()
+def test_adapters_give_different_features(make_feature_extractor, make_batch):
+    # otherwise the tests above couldn't tell the adapters apart
+    feature_extractor = make_feature_extractor()
+    batch = make_batch()
+    features = per_expert_features(feature_extractor, batch, [1] * len(INDICES))
+    other_features = per_expert_features(feature_extractor, batch, [2] * len(INDICES))
+    assert not torch.allclose(features, other_features)
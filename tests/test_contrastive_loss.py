@@ -0,0 +1,67 @@
+import torch
+import torch.nn as nn
+
+from models.EoE import description_contrastive_loss
+
+
+def reference_contrastive_loss(anchor_hidden_states, old_description_hidden_states, description_hidden_states, tau):
+    # the list/exp/log formulation that EoE.forward used before description_contrastive_loss
+    batch_size = anchor_hidden_states.size(0)
+    total_log_term = torch.zeros(1, dtype=anchor_hidden_states.dtype)
+    for k in range(description_hidden_states.size(1)):
+        numerator_list = []
+        denominator_list = []
+        for j in range(old_description_hidden_states.size(1)):
+            similarity = (anchor_hidden_states * old_description_hidden_states[:, j]).sum(dim=1, keepdim=True)
+            numerator_list.append(torch.exp(similarity / tau))
+            denominator_list.append(torch.exp(similarity / tau))
+        similarity = (anchor_hidden_states * description_hidden_states[:, k]).sum(dim=1, keepdim=True)
+        denominator_list.append(torch.exp(similarity / tau))
+        denominator = torch.sum(torch.stack(denominator_list), dim=0)
+        log_term = torch.zeros(batch_size, 1, dtype=anchor_hidden_states.dtype)
+        for numerator in numerator_list:
+            log_term += torch.log(numerator / denominator)
+        total_log_term += log_term.mean() / len(numerator_list)
+    return (total_log_term / description_hidden_states.size(1)).squeeze(0)
+
+
+def make_inputs(batch_size=8, num_old=5, num_descriptions=3, dim=64, scale=1.0):
+    generator = torch.Generator().manual_seed(0)
+    hidden_states = torch.randn(batch_size, dim, generator=generator, dtype=torch.float64)
+    old = scale * torch.randn(batch_size, num_old, dim, generator=generator, dtype=torch.float64)
+    descriptions = scale * torch.randn(batch_size, num_descriptions, dim, generator=generator, dtype=torch.float64)
+    return hidden_states, old, descriptions
+
+
+def loss_and_grads(loss_fn, hidden_states, old, descriptions, tau=0.8):
+    hidden_states, old, descriptions = [t.clone().requires_grad_() for t in (hidden_states, old, descriptions)]
+    loss = loss_fn(nn.functional.normalize(hidden_states, p=2, dim=-1), old, descriptions, tau)
+    loss.backward()
+    return loss.detach(), [t.grad for t in (hidden_states, old, descriptions)]
+
+
+def test_matches_reference_loss_and_gradients():
+    inputs = make_inputs()
+    loss, grads = loss_and_grads(description_contrastive_loss, *inputs)
+    reference_loss, reference_grads = loss_and_grads(reference_contrastive_loss, *inputs)
+    torch.testing.assert_close(loss, reference_loss)
+    for grad, reference_grad in zip(grads, reference_grads):
+        torch.testing.assert_close(grad, reference_grad)
+
+
+def test_single_old_description():
+    inputs = make_inputs(num_old=1, num_descriptions=1)
+    loss, grads = loss_and_grads(description_contrastive_loss, *inputs)
+    reference_loss, reference_grads = loss_and_grads(reference_contrastive_loss, *inputs)
+    torch.testing.assert_close(loss, reference_loss)
+    for grad, reference_grad in zip(grads, reference_grads):
+        torch.testing.assert_close(grad, reference_grad)
+
+
+def test_finite_with_large_similarities():
+    hidden_states, old, descriptions = [t.float() for t in make_inputs(scale=100.0)]
+    loss, grads = loss_and_grads(description_contrastive_loss, hidden_states, old, descriptions)
+    reference_loss, _ = loss_and_grads(reference_contrastive_loss, hidden_states, old, descriptions)
+    assert not torch.isfinite(reference_loss)
+    assert torch.isfinite(loss)
+    assert all(torch.isfinite(grad).all() for grad in grads)
@@ -0,0 +1,35 @@
+import torch
+
+
+def reference_entity_pooling(last_hidden_states, subject_st, subject_ed, object_st, object_ed):
+    # the per-sample loop of the entity extract mode before the span pooling was vectorized
+    hidden_states = []
+    for idx in range(last_hidden_states.size(0)):
+        subj = last_hidden_states[idx][subject_st[idx]: subject_ed[idx] + 1].mean(0)
+        obj = last_hidden_states[idx][object_st[idx]: object_ed[idx] + 1].mean(0)
+        hidden_states.append(torch.cat([subj, obj]))
+    return torch.stack(hidden_states, dim=0)
+
+
+@torch.no_grad()
+def test_matches_per_sample_pooling(make_feature_extractor, make_batch):
+    feature_extractor = make_feature_extractor(num_adapters=1)
+    batch = make_batch(batch_size=16)
+    features = feature_extractor(use_origin=True, extract_mode="entity", **batch)
+    last_hidden_states = feature_extractor.origin_bert(batch["input_ids"], attention_mask=batch["attention_mask"])[0]
+    reference = reference_entity_pooling(
+        last_hidden_states, batch["subject_st"], batch["subject_ed"], batch["object_st"], batch["object_ed"]
+    )
+    torch.testing.assert_close(features, reference)
+
+
+@torch.no_grad()
+def test_matches_single_sample_batches(make_feature_extractor, make_batch):
+    feature_extractor = make_feature_extractor(num_adapters=1)
+    batch = make_batch(batch_size=16)
+    features = feature_extractor(use_origin=True, extract_mode="entity", **batch)
+    for i in range(features.size(0)):
+        sample = {k: v[i:i + 1] for k, v in batch.items()}
+        torch.testing.assert_close(
+            features[i:i + 1], feature_extractor(use_origin=True, extract_mode="entity", **sample)
+        )
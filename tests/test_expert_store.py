@@ -0,0 +1,44 @@
+from types import SimpleNamespace
+
+import pytest
+
+from models.ExpertStore import ExpertStore
+
+
+class CountingStore(ExpertStore):
+    """
+    ExpertStore without model tensors: evicting and paging in only touch the expert's file.
+    """
+
+    def evict(self, e_id):
+        del self.resident[e_id]
+        self.evictions += 1
+        open(self.path(e_id), "w").close()
+
+    def page_in(self, e_id):
+        pass
+
+
+@pytest.mark.parametrize("training, expected_hits", [(True, 0), (False, 2)], ids=["lru", "mru"])
+def test_eval_sweep_keeps_experts_resident(tmp_path, training, expected_hits):
+    store = CountingStore(SimpleNamespace(training=training), str(tmp_path), budget=3)
+    expert_ids = list(range(-1, 5))
+    for e_id in expert_ids:
+        store.touch(e_id)
+    for _ in range(4):
+        store.reset_stats()
+        for e_id in expert_ids:
+            store.touch(e_id)
+            assert e_id in store.resident and len(store.resident) == 3
+        # a sweep over 6 experts with room for 3 evicts every expert under LRU, it hits the first 2 otherwise
+        assert store.hits == expected_hits
+    store.close()
+
+
+def test_group_is_evicted_to_budget_after_use(tmp_path):
+    store = CountingStore(SimpleNamespace(training=False), str(tmp_path), budget=2)
+    for e_id in range(4):
+        store.touch(e_id, evict=False)
+    store.evict_to_budget()
+    assert len(store.resident) == 2
+    store.close()
@@ -0,0 +1,66 @@
+from types import SimpleNamespace
+
+import torch
+from transformers import set_seed
+
+from models import EoE
+
+SEED = 2021
+NUM_TASKS = 3
+
+
+def make_model(tiny_bert_path):
+    return EoE(SimpleNamespace(
+        device="cpu",
+        dataset_name="FewRel",
+        task_name="RelationExtraction",
+        model_name_or_path=tiny_bert_path,
+        additional_special_tokens_len=4,
+        peft_type="lora",
+        frozen=True,
+        class_per_task=2,
+        default_expert="task",
+        query_mode="mahalanobis",
+        max_expert=-1,
+        independent_tasks=True,
+    ))
+
+
+def start_task(model, task_idx):
+    # what prepare_task and new_task do for task_idx in the sequential sweep and in train_expert
+    set_seed(SEED + task_idx)
+    model.new_task(2)
+
+
+def trainable_state(model):
+    return {name: param.detach().clone() for name, param in model.named_parameters() if param.requires_grad}
+
+
+@torch.no_grad()
+def test_expert_starts_from_the_same_state_as_in_the_sequential_sweep(tiny_bert_path):
+    """
+    With independent_tasks, the expert of the last task starts training from the same parameters and random
+    state after training the earlier tasks (sequential sweep) as after replaying them untrained (train_expert
+    of parallel_experts), so both schedules train the same expert and get the same accuracies.
+    """
+    sequential = make_model(tiny_bert_path)
+    for task_idx in range(NUM_TASKS):
+        start_task(sequential, task_idx)
+        if task_idx < NUM_TASKS - 1:
+            # stands in for the training of the task, which changes every trainable parameter
+            for param in sequential.parameters():
+                if param.requires_grad:
+                    param.add_(torch.randn_like(param))
+    state = trainable_state(sequential)
+    rng = torch.rand(4)
+
+    replayed = make_model(tiny_bert_path)
+    for task_idx in range(NUM_TASKS):
+        start_task(replayed, task_idx)
+    replayed_state = trainable_state(replayed)
+
+    assert state.keys() == replayed_state.keys()
+    assert any("output_layer" in name for name in state)
+    for name, value in state.items():
+        torch.testing.assert_close(value, replayed_state[name], rtol=0, atol=0, msg=name)
+    torch.testing.assert_close(rng, torch.rand(4), rtol=0, atol=0)
@@ -0,0 +1,36 @@
+import pytest
+import torch
+
+INDICES = [1, 3, 1, 2, 0, 3, 2, 1]
+
+
+def marker_only_and_full(feature_extractor, batch, **kwargs):
+    feature_extractor.marker_only_last_layer = True
+    marker_only = feature_extractor(**batch, **kwargs)
+    feature_extractor.marker_only_last_layer = False
+    full = feature_extractor(**batch, **kwargs)
+    return marker_only, full
+
+
+@pytest.mark.parametrize("kwargs", [
+    {},
+    {"use_origin": True},
+    {"indices": INDICES},
+    {"indices": INDICES, "use_view": True},
+], ids=["first_task_bert", "origin_bert", "lora", "lora_view"])
+@torch.no_grad()
+def test_matches_full_last_layer(make_feature_extractor, make_batch, kwargs):
+    feature_extractor = make_feature_extractor()
+    marker_only, full = marker_only_and_full(feature_extractor, make_batch(), **kwargs)
+    assert marker_only.shape == full.shape
+    torch.testing.assert_close(marker_only, full)
+
+
+@pytest.mark.parametrize("indices", [None, INDICES], ids=["first_task_bert", "lora"])
+@torch.no_grad()
+def test_matches_full_last_layer_from_trunk(make_feature_extractor, make_batch, indices):
+    feature_extractor = make_feature_extractor(adapter_layers=2)
+    batch = make_batch()
+    trunk_states = feature_extractor.encode_trunk(batch["input_ids"], batch["attention_mask"])
+    marker_only, full = marker_only_and_full(feature_extractor, batch, indices=indices, trunk_states=trunk_states)
+    torch.testing.assert_close(marker_only, full)
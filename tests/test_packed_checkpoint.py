@@ -0,0 +1,28 @@
+from types import SimpleNamespace
+
+import pytest
+
+from models import EoE
+
+
+@pytest.mark.parametrize("peft_type", ["prefix", "prompt"])
+def test_non_lora_models_are_rejected(tiny_bert_path, tmp_path, peft_type):
+    model = EoE(SimpleNamespace(
+        device="cpu",
+        dataset_name="FewRel",
+        task_name="RelationExtraction",
+        model_name_or_path=tiny_bert_path,
+        additional_special_tokens_len=4,
+        peft_type=peft_type,
+        pre_seq_len=4,
+        frozen=True,
+        class_per_task=2,
+        default_expert="task",
+        query_mode="mahalanobis",
+        max_expert=-1,
+    ))
+    with pytest.raises(NotImplementedError):
+        model.packed_state()
+    # rejected before the file is opened
+    with pytest.raises(NotImplementedError):
+        model.load_packed(str(tmp_path / "experts.safetensors"))
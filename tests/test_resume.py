@@ -0,0 +1,119 @@
+from types import SimpleNamespace
+
+import pytest
+import torch
+from transformers import set_seed
+
+from models import EoE
+from trainers import EoETrainer
+from trainers.EoETrainer import get_rng_state, set_rng_state
+from utils import flush_checkpoints
+
+CLASS_PER_TASK = 2
+NUM_TASKS = 3
+
+
+def make_model(tiny_bert_path, tmp_path, routing_proj, resident_experts):
+    # run_round seeds before the model is built, which initializes the embeddings of the marker tokens
+    set_seed(2021)
+    return EoE(SimpleNamespace(
+        device="cpu",
+        dataset_name="FewRel",
+        task_name="RelationExtraction",
+        model_name_or_path=tiny_bert_path,
+        additional_special_tokens_len=4,
+        peft_type="lora",
+        frozen=True,
+        class_per_task=CLASS_PER_TASK,
+        default_expert="task",
+        query_mode="mahalanobis",
+        max_expert=-1,
+        routing_proj=routing_proj,
+        routing_dim=8,
+        resident_experts=resident_experts,
+        expert_store_dir=str(tmp_path / "store"),
+    ))
+
+
+def random_statistic(dim, generator):
+    # class means, shared covariance and task-level gaussian as given by get_mean_and_cov
+    features = torch.randn(4 * dim, dim, generator=generator)
+    cov = torch.cov(features.T)
+    return torch.randn(CLASS_PER_TASK, dim, generator=generator), cov, torch.randn(dim, generator=generator), 2 * cov
+
+
+def first_task_checkpoint(model, path, generator):
+    # a first-task model in the layout of the Expert stage, with other weights than the pretrained bert
+    torch.save({
+        "model": {
+            k: v + 0.01 * torch.randn(v.shape, generator=generator)
+            for k, v in model.feature_extractor.bert.state_dict().items()
+        },
+        "linear": {
+            "weight": torch.randn(model.classifier[0].weight.shape, generator=generator),
+            "bias": torch.randn(model.classifier[0].bias.shape, generator=generator),
+        },
+    }, path)
+
+
+def assert_models_equal(model, resumed):
+    state, resumed_state = model.state_dict(), resumed.state_dict()
+    assert state.keys() == resumed_state.keys()
+    for k, v in state.items():
+        torch.testing.assert_close(resumed_state[k], v, rtol=0, atol=0, msg=k)
+    distributions, resumed_distributions = model.expert_distributions(), resumed.expert_distributions()
+    assert len(distributions) == len(resumed_distributions)
+    for distribution, resumed_distribution in zip(distributions, resumed_distributions):
+        assert distribution.keys() == resumed_distribution.keys()
+        for field, value in distribution.items():
+            torch.testing.assert_close(resumed_distribution[field], value, rtol=0, atol=0, msg=field)
+
+
+@pytest.mark.parametrize("routing_proj, resident_experts", [("none", -1), ("pca", -1), ("none", 2)],
+                         ids=["full", "pca", "expert_store"])
+@torch.no_grad()
+def test_resumed_model_matches_uninterrupted_model(tiny_bert_path, tmp_path, routing_proj, resident_experts):
+    """
+    Save the resume state after every task like EoETrainer.run, then rebuild a fresh model from the state
+    after the last task the way run resumes: replay the tasks without training and load the state.
+    """
+    trainer = EoETrainer(args=SimpleNamespace(device="cpu"))
+    ckpt_dir = str(tmp_path / "ckpt")
+    generator = torch.Generator().manual_seed(0)
+    model = make_model(tiny_bert_path, tmp_path / "model", routing_proj, resident_experts)
+    for task_idx in range(NUM_TASKS):
+        model.new_task(CLASS_PER_TASK)
+        if task_idx == 0:
+            first_task_checkpoint(model, tmp_path / "first_task.pth", generator)
+            model.load_expert_model(str(tmp_path / "first_task.pth"))
+        else:
+            # stands in for the training of the task
+            for param in model.parameters():
+                if param.requires_grad:
+                    param.add_(torch.randn(param.shape, generator=generator))
+        model.feature_extractor.register_adapter(task_idx, save_dir=None, save=False)
+        for expert_id in range(-1, task_idx + 1):
+            model.new_statistic(*random_statistic(model.query_size, generator), expert_id)
+        trainer.save_resume_state(ckpt_dir, model, {
+            "task_idx": task_idx,
+            "num_train_labels": [CLASS_PER_TASK] * (task_idx + 1),
+            "rng": get_rng_state(),
+        })
+    flush_checkpoints()
+    rng = torch.rand(4)
+
+    state = trainer.load_resume_state(ckpt_dir)
+    assert state["task_idx"] == NUM_TASKS - 1
+    resumed = make_model(tiny_bert_path, tmp_path / "resumed", routing_proj, resident_experts)
+    for task_idx in range(NUM_TASKS):
+        resumed.new_task(state["num_train_labels"][task_idx])
+        if task_idx == 0:
+            resumed.load_expert_model(str(tmp_path / "first_task.pth"))
+        resumed.feature_extractor.register_adapter(task_idx, save_dir=ckpt_dir, save=False)
+    resumed.load_task_state_dict(state["model"], state["distribution"])
+    set_rng_state(state["rng"])
+
+    assert_models_equal(model, resumed)
+    torch.testing.assert_close(torch.rand(4), rng, rtol=0, atol=0)
+    model.close()
+    resumed.close()
@@ -0,0 +1,97 @@
+from types import SimpleNamespace
+
+import pytest
+import torch
+
+from models import EoE
+
+CLASS_PER_TASK = 2
+ROUTING_DIM = 4
+
+
+def make_model(tiny_bert_path, routing_proj):
+    return EoE(SimpleNamespace(
+        device="cpu",
+        dataset_name="FewRel",
+        task_name="RelationExtraction",
+        model_name_or_path=tiny_bert_path,
+        additional_special_tokens_len=4,
+        peft_type="lora",
+        frozen=True,
+        class_per_task=CLASS_PER_TASK,
+        default_expert="task",
+        query_mode="mahalanobis",
+        max_expert=-1,
+        routing_proj=routing_proj,
+        routing_dim=ROUTING_DIM,
+    ))
+
+
+def task_statistic(wide_dims, std, seed, per_class=50):
+    """
+    The statistics of get_mean_and_cov for a task whose features vary with std along wide_dims only.
+    """
+    generator = torch.Generator().manual_seed(seed)
+    scale = torch.full((64,), 0.1, dtype=torch.float64)
+    scale[wide_dims] = std
+    features = torch.randn(CLASS_PER_TASK, per_class, 64, generator=generator, dtype=torch.float64) * scale
+    features[1] += 0.5
+    mean = features.mean(dim=1)
+    cov = torch.stack([torch.cov(class_features.T) for class_features in features]).mean(dim=0)
+    all_features = features.reshape(-1, 64)
+    return mean.float(), cov.float(), all_features.mean(dim=0).float(), torch.cov(all_features.T).float()
+
+
+def add_task(model, statistic):
+    model.new_task(CLASS_PER_TASK)
+    model.new_statistic(*statistic, expert_id=-1)
+    return model.expert_distribution[model.shift_expert_id(-1)]
+
+
+def assert_projected(distribution):
+    proj = distribution["proj"]
+    for field in ["class_mean", "task_mean"]:
+        for value, full_value in zip(distribution[field], distribution[f"full_{field}"]):
+            torch.testing.assert_close(value, full_value @ proj)
+    for field in ["accumulate_cov", "accumulate_task_cov"]:
+        torch.testing.assert_close(distribution[field], proj.T @ distribution[f"full_{field}"] @ proj)
+
+
+@torch.no_grad()
+def test_pca_is_refitted_with_later_tasks(tiny_bert_path):
+    model = make_model(tiny_bert_path, "pca")
+    distribution = add_task(model, task_statistic(list(range(0, 4)), std=5.0, seed=0))
+    assert_projected(distribution)
+    assert (distribution["proj"][0:4] ** 2).sum() > 0.9 * ROUTING_DIM
+    # the classes of the second task vary along other axes with more variance, the basis follows them
+    distribution = add_task(model, task_statistic(list(range(4, 8)), std=10.0, seed=1))
+    assert_projected(distribution)
+    assert (distribution["proj"][4:8] ** 2).sum() > 0.9 * ROUTING_DIM
+    assert distribution["class_mean"][-1].shape == (CLASS_PER_TASK, ROUTING_DIM)
+    assert distribution["cov_inv"].shape == (ROUTING_DIM, ROUTING_DIM)
+
+
+@torch.no_grad()
+def test_random_projection_is_drawn_once(tiny_bert_path):
+    model = make_model(tiny_bert_path, "random")
+    proj = add_task(model, task_statistic(list(range(0, 4)), std=5.0, seed=0))["proj"].clone()
+    distribution = add_task(model, task_statistic(list(range(4, 8)), std=10.0, seed=1))
+    torch.testing.assert_close(distribution["proj"], proj)
+    assert_projected(distribution)
+
+
+@pytest.mark.parametrize("routing_proj", ["pca", "random"])
+@torch.no_grad()
+def test_rebuilt_distribution_keeps_full_statistics(tiny_bert_path, routing_proj):
+    model = make_model(tiny_bert_path, routing_proj)
+    add_task(model, task_statistic(list(range(0, 4)), std=5.0, seed=0))
+    distribution = model.expert_distribution[0]
+    tensors = {}
+    for field, value in distribution.items():
+        if isinstance(value, list):
+            tensors.update({f"{field}.{t}": v for t, v in enumerate(value)})
+        elif value is not None:
+            tensors[field] = value
+    rebuilt = model.distribution_from_tensors(tensors, len(distribution["class_mean"]))
+    assert rebuilt.keys() == distribution.keys()
+    assert_projected(rebuilt)
@@ -0,0 +1,93 @@
+from types import SimpleNamespace
+
+import pytest
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+import torch.nn as nn
+
+from trainers import EoETrainer
+from utils import is_distributed
+
+
+class FeatureModel(nn.Module):
+    """
+    Stands in for EoE in get_mean_and_cov: the hidden states of every expert are the features of the sample.
+    """
+
+    def __init__(self, dim):
+        super().__init__()
+        self.query_size = dim
+
+    def forward(self, features, return_hidden_states=False, task_idx=None):
+        return features
+
+
+def make_dataset(num_classes=3, per_class=20, dim=6):
+    generator = torch.Generator().manual_seed(0)
+    dataset = []
+    for c in range(num_classes):
+        # features far from the origin, so that the outer-product sums cancel a lot
+        features = 5.0 + c + torch.randn(per_class, dim, generator=generator)
+        dataset += [{"features": x, "labels": 10 + c} for x in features]
+    # the classes are interleaved over the batches
+    order = torch.randperm(len(dataset), generator=generator).tolist()
+    return [dataset[i] for i in order]
+
+
+def reference_statistics(dataset):
+    # class means, shared covariance and task-level gaussian of the concatenated features
+    features = torch.stack([sample["features"] for sample in dataset]).double()
+    labels = torch.tensor([sample["labels"] for sample in dataset])
+    classes = sorted(set(labels.tolist()))
+    mean = torch.stack([features[labels == c].mean(dim=0) for c in classes])
+    cov = torch.stack([torch.cov(features[labels == c].T) for c in classes]).mean(dim=0)
+    return mean, cov, features.mean(dim=0), torch.cov(features.T)
+
+
+@pytest.fixture
+def process_group(tmp_path):
+    dist.init_process_group("gloo", init_method=f"file://{tmp_path}/process_group", rank=0, world_size=1)
+    yield
+    dist.destroy_process_group()
+
+
+def get_mean_and_cov(dataset, local=False):
+    trainer = EoETrainer(args=SimpleNamespace(eval_batch_size=7, device="cpu"))
+    return trainer.get_mean_and_cov(FeatureModel(dataset[0]["features"].size(0)), dataset, None, local=local)
+
+
+def assert_statistics_close(statistics, reference):
+    for value, reference_value in zip(statistics, reference):
+        torch.testing.assert_close(value, reference_value.float())
+
+
+def test_matches_concatenated_statistics():
+    dataset = make_dataset()
+    assert_statistics_close(get_mean_and_cov(dataset), reference_statistics(dataset))
+
+
+def test_all_reduced_matches_concatenated_statistics(process_group):
+    # one process still goes through shard_dataset, gather_shards and all_reduce_sum
+    assert is_distributed()
+    dataset = make_dataset()
+    statistics = get_mean_and_cov(dataset)
+    assert_statistics_close(statistics, reference_statistics(dataset))
+    for value, local_value in zip(statistics, get_mean_and_cov(dataset, local=True)):
+        torch.testing.assert_close(value, local_value, rtol=0, atol=0)
+
+
+def two_process_worker(rank, path):
+    dist.init_process_group("gloo", init_method=f"file://{path}", rank=rank, world_size=2)
+    # a class whose samples are all in the shard of one rank, so that the ranks see different label sets
+    dataset = make_dataset()
+    for i in [-1, -3]:
+        dataset[i] = {"features": dataset[i]["features"] - 5.0, "labels": 20}
+    try:
+        assert_statistics_close(get_mean_and_cov(dataset), reference_statistics(dataset))
+    finally:
+        dist.destroy_process_group()
+
+
+def test_two_processes_match_concatenated_statistics(tmp_path):
+    mp.spawn(two_process_worker, args=(f"{tmp_path}/process_group",), nprocs=2)
@@ -0,0 +1,24 @@
+import pytest
+import torch
+
+
+@torch.no_grad()
+def test_cached_trunk_matches_encoded_trunk(make_feature_extractor, make_batch, tmp_path):
+    # room for about one batch, the second batch is served partly from the cache and partly encoded
+    feature_extractor = make_feature_extractor(
+        adapter_layers=2, trunk_dropout=False, trunk_cache=True, trunk_cache_dir=str(tmp_path), trunk_cache_max_mb=1
+    )
+    feature_extractor.trunk_cache.max_rows = 80
+    for seed in [0, 1, 0, 1]:
+        batch = make_batch(seed=seed)
+        mask = batch["attention_mask"].unsqueeze(-1)
+        reference = feature_extractor.encode_trunk(batch["input_ids"], batch["attention_mask"]) * mask
+        trunk_states = feature_extractor.get_trunk_states(batch["input_ids"], batch["attention_mask"])
+        torch.testing.assert_close(trunk_states, reference)
+        assert feature_extractor.trunk_cache.num_rows <= 80
+    feature_extractor.close_trunk_cache()
+
+
+def test_trunk_cache_needs_trunk_without_dropout(make_feature_extractor, tmp_path):
+    with pytest.raises(ValueError):
+        make_feature_extractor(adapter_layers=2, trunk_cache=True, trunk_cache_dir=str(tmp_path))
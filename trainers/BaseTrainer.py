@@ -1,5 +1,5 @@
 import torch
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, DistributedSampler
 from transformers import DataCollatorWithPadding, set_seed, get_linear_schedule_with_warmup
 from torch.optim import AdamW
 from data import BaseDataset
@@ -8,7 +8,8 @@ from tqdm import tqdm
 import torch.nn as nn
 import numpy as np
 from sklearn import metrics
-from utils import CustomCollatorWithPadding
+from utils import CustomCollatorWithPadding, is_distributed, is_main_process, wrap_model, unwrap_model
+from utils import log_metrics, latest_metric
 
 logger = logging.getLogger(__name__)
 
@@ -20,6 +21,7 @@ class BaseTrainer:
     def run(self, data, model, tokenizer, label_order, seed=None):
         if seed is not None:
             set_seed(seed)
+        model = unwrap_model(model)
         default_data_collator = CustomCollatorWithPadding(tokenizer)
 
         seen_labels = []
@@ -78,10 +80,13 @@ class BaseTrainer:
         }
 
     def train(self, model, train_dataset, data_collator):
+        # each process trains on its own shard of the data under torchrun
+        sampler = DistributedSampler(train_dataset, shuffle=True) if is_distributed() else None
         train_dataloader = DataLoader(
             train_dataset,
             batch_size=self.args.train_batch_size,
-            shuffle=True,
+            shuffle=sampler is None,
+            sampler=sampler,
             collate_fn=data_collator
         )
         len_dataloader = len(train_dataloader)
@@ -113,15 +118,18 @@ class BaseTrainer:
             if param.requires_grad:
                 print(name)
 
-        progress_bar = tqdm(range(max_steps))
+        progress_bar = tqdm(range(max_steps), disable=not is_main_process())
 
+        train_model = wrap_model(model)
         for epoch in range(self.args.num_train_epochs):
-            model.train()
+            if sampler is not None:
+                sampler.set_epoch(epoch)
+            train_model.train()
             for step, inputs in enumerate(train_dataloader):
                 optimizer.zero_grad()
 
                 inputs = {k: v.to(self.args.device) for k, v in inputs.items()}
-                outputs = model(**inputs)
+                outputs = train_model(**inputs)
                 loss = outputs["loss"] if isinstance(outputs, dict) else outputs[0]
                 loss.backward()
                 nn.utils.clip_grad_norm_(model.parameters(), self.args.max_grad_norm)
@@ -129,8 +137,13 @@ class BaseTrainer:
                 optimizer.step()
                 # scheduler.step()
 
+                log_metrics({"train/loss": loss})
                 progress_bar.update(1)
-                progress_bar.set_postfix({"Loss": loss.item()})
+                # the loss of an earlier step as written out by the metrics thread, loss.item() would wait for
+                # the device on every step
+                loss_value = latest_metric("train/loss")
+                if loss_value is not None:
+                    progress_bar.set_postfix({"Loss": loss_value}, refresh=False)
 
         progress_bar.close()
 
@@ -150,7 +163,7 @@ class BaseTrainer:
         logger.info(f"  Num examples = {num_examples}")
         logger.info(f"  Eval batch size = {self.args.eval_batch_size}")
 
-        progress_bar = tqdm(range(len_dataloader))
+        progress_bar = tqdm(range(len_dataloader), disable=not is_main_process())
 
         golds = []
         preds = []
@@ -1,26 +1,76 @@
 import copy
 import logging
 import os
-import pickle
+import multiprocessing
+import random
+import time
+from concurrent.futures import ProcessPoolExecutor
 
-import hydra
+import numpy as np
 import torch
 import torch.nn as nn
 from sklearn import metrics
 from torch.optim import AdamW
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, DistributedSampler
 from tqdm import tqdm
 from transformers import set_seed
-import wandb as loggerdb
 
 
 from data import BaseDataset
+from models import EoE
 from trainers import BaseTrainer
-from utils import CustomCollatorWithPadding, relation_data_augmentation
+from utils import CustomCollatorWithPadding, relation_data_augmentation, log_metrics, latest_metric
+from utils import is_distributed, is_main_process, barrier, wrap_model, unwrap_model, get_rank, get_world_size
+from utils import shard_dataset, gather_shards, gather_objects, all_reduce_sum
+from utils import save_checkpoint, flush_checkpoints, pickle_dump, packed_save, resident_memory_mb, setup_logging
 
 logger = logging.getLogger(__name__)
 
 
+def get_rng_state():
+    return {
+        "python": random.getstate(),
+        "numpy": np.random.get_state(),
+        "torch": torch.get_rng_state(),
+        "cuda": torch.cuda.get_rng_state_all() if torch.cuda.is_available() else [],
+    }
+
+
+def set_rng_state(state):
+    random.setstate(state["python"])
+    np.random.set_state(state["numpy"])
+    torch.set_rng_state(state["torch"])
+    if torch.cuda.is_available() and len(state["cuda"]) == torch.cuda.device_count():
+        torch.cuda.set_rng_state_all(state["cuda"])
+
+
+def train_expert_in_worker(args, data, tokenizer, label_order, seed, task_idx, ckpt_dir, num_threads):
+    setup_logging(args.log_file if hasattr(args, "log_file") else None)
+    torch.set_num_threads(num_threads)
+    if str(args.device).startswith("cuda") and torch.cuda.device_count() > 1:
+        args.device = f"cuda:{task_idx % torch.cuda.device_count()}"
+        torch.cuda.set_device(args.device)
+    EoETrainer(args=args).train_expert(data, tokenizer, label_order, seed, task_idx, ckpt_dir)
+
+
+# trainer, model, training datasets and collator of a statistic worker process
+statistic_worker = None
+
+
+def init_statistic_worker(args, data, tokenizer, label_order, seed, ckpt_dir, num_threads):
+    global statistic_worker
+    setup_logging(args.log_file if hasattr(args, "log_file") else None)
+    torch.set_num_threads(num_threads)
+    trainer = EoETrainer(args=args)
+    model, train_datasets = trainer.load_trained_model(data, tokenizer, label_order, seed, ckpt_dir)
+    statistic_worker = (trainer, model, train_datasets, CustomCollatorWithPadding(tokenizer))
+
+
+def statistic_cells_in_worker(cells):
+    trainer, model, train_datasets, data_collator = statistic_worker
+    return trainer.compute_statistic_cells(model, train_datasets, data_collator, cells)
+
+
 class EoETrainer(BaseTrainer):
     def __init__(self, args, **kwargs):
         super().__init__(args, **kwargs)
@@ -31,47 +81,85 @@ class EoETrainer(BaseTrainer):
         if seed is not None:
             set_seed(seed)
             self.cur_seed = seed
+        model = unwrap_model(model)
+        # evaluate a finished run from its packed checkpoint instead of training
+        packed_checkpoint_path = self.args.packed_checkpoint_path \
+            if hasattr(self.args, "packed_checkpoint_path") else None
+        packed_checkpoint = hasattr(self.args, "packed_checkpoint") and self.args.packed_checkpoint
+        if (packed_checkpoint_path or packed_checkpoint) and model.peft_type != "lora":
+            # fail before training instead of when the checkpoint is written at the end of the run
+            raise NotImplementedError("packed checkpoints only hold lora experts")
+        if packed_checkpoint_path:
+            return self.eval_packed(data, model, tokenizer, label_order, packed_checkpoint_path)
         default_data_collator = CustomCollatorWithPadding(tokenizer)
+        ckpt_dir = f"./ckpt/{self.args.dataset_name}-{seed}-{self.args.augment_type}"
+
+        # save the state after every task and restart after the last task saved by an interrupted run
+        resume_file = f"{ckpt_dir}/resume.pt"
+        resume = self.args.resume if hasattr(self.args, "resume") else False
+        state = self.load_resume_state(ckpt_dir) if resume and os.path.exists(resume_file) else None
+        first_task = 0 if state is None else state["task_idx"] + 1
+
+        # train the experts of all tasks first, then replay the tasks for the statistics and evaluation
+        parallel_experts = self.args.parallel_experts if hasattr(self.args, "parallel_experts") else False
+        if parallel_experts and not model.independent_tasks:
+            # the default schedule carries the description head and the random state from task to task
+            raise ValueError("parallel_experts trains the independent_tasks variant, set independent_tasks=true")
+        if parallel_experts:
+            logger.warning("parallel_experts is experimental, it trains the independent_tasks algorithm and its "
+                           "wall-clock savings have not been measured")
+        # reuse the experts saved in ckpt_dir and only rebuild the statistics, e.g. after changing query_mode
+        reuse_experts = self.args.reuse_experts if hasattr(self.args, "reuse_experts") else False
+        experts_saved = parallel_experts or reuse_experts
+        # the resume state is written during the sweep, so all experts were trained
+        if parallel_experts and not reuse_experts and state is None:
+            self.train_experts_in_parallel(data, tokenizer, label_order, seed, ckpt_dir)
+        statistic_executor = None
+        if experts_saved:
+            statistic_executor = self.start_statistic_workers(data, tokenizer, label_order, seed, ckpt_dir)
 
         seen_labels = []
         all_cur_acc = []
         all_total_acc = []
         all_total_hit = []
+        all_num_train_labels = []
         marker_ids = tuple([tokenizer.convert_tokens_to_ids(c) for c in self.args.additional_special_tokens])
         logger.info(f"marker ids: {marker_ids}")
-        for task_idx in range(self.args.num_tasks):
+        if state is not None:
+            for task_idx in range(first_task):
+                self.task_idx = task_idx
+                self.prepare_task(
+                    data, model, tokenizer, label_order, seed, task_idx, seen_labels, marker_ids, augment=False
+                )
+                model.new_task(state["num_train_labels"][task_idx])
+                if task_idx == 0:
+                    model.load_expert_model(f"./ckpt/{self.args.dataset_name}_{seed}_{self.args.augment_type}.pth")
+                model.feature_extractor.register_adapter(task_idx, save_dir=ckpt_dir, save=False)
+            if data.label2id != state["label2id"] or data.label2task_id != state["label2task_id"]:
+                raise ValueError(f"the labels of {resume_file} don't match the label order of this run")
+            model.load_task_state_dict(state["model"], state["distribution"])
+            all_cur_acc = state["cur_acc"]
+            all_total_acc = state["total_acc"]
+            all_total_hit = state["total_hit"]
+            all_num_train_labels = state["num_train_labels"]
+            set_rng_state(state["rng"])
+            logger.info(f"resume from task {first_task + 1} with {resume_file}")
+        for task_idx in range(first_task, self.args.num_tasks):
             self.task_idx = task_idx
-            cur_labels = [data.label_list[c] for c in label_order[task_idx]]
-            data.add_labels(cur_labels, task_idx)
-
-            logger.info(f"***** Task-{task_idx + 1} *****")
-            logger.info(f"Current classes: {' '.join(cur_labels)}")
-
-            train_data = data.filter(cur_labels, "train")
-            train_dataset = BaseDataset(train_data)
-            
-            for cur_label in cur_labels:
-                model.take_generate_description_MrLinh_from_file(cur_label, data.label2id[cur_label], self.args.dataset_name, tokenizer)
-
-            pool = model.get_description_ids(cur_labels)
-            old_pool = model.get_description_ids(seen_labels)
-            train_data_have_des = data.filter_and_add_desciption_and_old_description(cur_labels, pool, seen_labels, old_pool) 
-            
-            num_train_labels = len(cur_labels)
-            
-            seen_labels += cur_labels
-                        
-            aug_train_data, num_train_labels = relation_data_augmentation(
-                copy.deepcopy(train_data_have_des), len(seen_labels), copy.deepcopy(data.id2label), marker_ids, self.args.augment_type
+            cur_labels, train_dataset, aug_train_dataset, num_train_labels = self.prepare_task(
+                data, model, tokenizer, label_order, seed, task_idx, seen_labels, marker_ids
             )
-            aug_train_dataset = BaseDataset(aug_train_data)            
-            
-            model.new_task(num_train_labels)
+            all_num_train_labels.append(num_train_labels)
 
+            model.new_task(num_train_labels)
             if self.task_idx == 0:
                 expert_model = f"./ckpt/{self.args.dataset_name}_{seed}_{self.args.augment_type}.pth"
                 model.load_expert_model(expert_model)
                 logger.info(f"load first task model from {expert_model}")
+            elif experts_saved:
+                model.load_classifier(self.task_idx, ckpt_dir)
+                model.feature_extractor.load_adapter_weights(self.task_idx, ckpt_dir)
+                logger.info(f"load expert of task {self.task_idx} from {ckpt_dir}")
             else:
                 self.train(
                     model=model,
@@ -79,19 +167,24 @@ class EoETrainer(BaseTrainer):
                     data_collator=default_data_collator
                 )
 
-            os.makedirs(f"./ckpt/{self.args.dataset_name}-{seed}-{self.args.augment_type}", exist_ok=True)
-            model.save_classifier(
-                idx=self.task_idx,
-                save_dir=f"./ckpt/{self.args.dataset_name}-{seed}-{self.args.augment_type}",
-            )
+            # the processes hold the same weights after training, only the main process writes them
+            if is_main_process() and not (experts_saved and self.task_idx > 0):
+                os.makedirs(ckpt_dir, exist_ok=True)
+                model.save_classifier(
+                    idx=self.task_idx,
+                    save_dir=ckpt_dir,
+                )
 
-            model.feature_extractor.save_and_load_all_adapters(
+            model.feature_extractor.register_adapter(
                 self.task_idx,
-                save_dir=f"./ckpt/{self.args.dataset_name}-{seed}-{self.args.augment_type}",
-                save=True,
+                save_dir=ckpt_dir,
+                save=is_main_process() and not (experts_saved and self.task_idx > 0),
             )
+            barrier()
 
-            self.statistic(model, train_dataset, default_data_collator)
+            cells = self.statistic_grid(model, train_dataset, default_data_collator, statistic_executor) \
+                if experts_saved else None
+            self.statistic(model, train_dataset, default_data_collator, cells)
 
             cur_test_data = data.filter(cur_labels, 'test')
             history_test_data = data.filter(seen_labels, 'test')
@@ -119,20 +212,97 @@ class EoETrainer(BaseTrainer):
             all_cur_acc.append(cur_acc)
             all_total_acc.append(total_acc)
             all_total_hit.append(total_hit)
-            loggerdb.log({"train/all_cur_acc": cur_acc})
-            loggerdb.log({"train/all_total_acc": total_acc})
-            loggerdb.log({"train/all_total_hit": total_hit})
+            log_metrics({"train/all_cur_acc": cur_acc, "train/all_total_acc": total_acc, "train/all_total_hit": total_hit})
+
+            if resume:
+                if is_main_process():
+                    self.save_resume_state(ckpt_dir, model, {
+                        "task_idx": task_idx,
+                        "seen_labels": seen_labels,
+                        "label2id": data.label2id,
+                        "label2task_id": data.label2task_id,
+                        "num_train_labels": all_num_train_labels,
+                        "cur_acc": all_cur_acc,
+                        "total_acc": all_total_acc,
+                        "total_hit": all_total_hit,
+                        "rng": get_rng_state(),
+                    })
+                barrier()
+
+        if statistic_executor is not None:
+            statistic_executor.shutdown()
 
         # save distribution
         save_data = {
-            "distribution": model.expert_distribution,
+            "distribution": model.expert_distributions(),
             "seen_labels": seen_labels,
             "label2id": data.label2id,
         }
         save_file = f"{self.cur_seed}_distribution.pickle"
-        save_dir = hydra.core.hydra_config.HydraConfig.get().runtime.output_dir
-        with open(save_dir + "/" + save_file, 'wb') as file:
-            pickle.dump(save_data, file)
+        save_dir = self.args.run_dir
+        if is_main_process():
+            save_checkpoint(save_data, save_dir + "/" + save_file, write=pickle_dump)
+            if packed_checkpoint:
+                save_checkpoint(
+                    model.packed_state(seen_labels), f"{ckpt_dir}/experts.safetensors", write=packed_save
+                )
+        flush_checkpoints()
+        model.close()
+
+        return {
+            "cur_acc": all_cur_acc,
+            "total_acc": all_total_acc,
+            "total_hit": all_total_hit,
+        }
+
+    def eval_packed(self, data, model, tokenizer, label_order, path):
+        """
+        Evaluate a finished run without training: model is rebuilt from the packed checkpoint at path, which
+        reads an expert only when it is first used, and the final model is evaluated on the test data of each
+        task on its own (cur_acc) and together with the earlier tasks (total_acc, total_hit).
+        """
+        model.load_packed(path)
+        if len(model.classifier) != self.args.num_tasks:
+            raise ValueError(f"{path} holds {len(model.classifier)} tasks instead of {self.args.num_tasks}")
+        task_labels = []
+        for task_idx in range(self.args.num_tasks):
+            cur_labels = [data.label_list[c] for c in label_order[task_idx]]
+            data.add_labels(cur_labels, task_idx)
+            task_labels.append(cur_labels)
+        packed_labels = model.packed.metadata.get("labels")
+        if packed_labels is not None and packed_labels != sum(task_labels, []):
+            raise ValueError(f"the labels of {path} don't match the label order of this run")
+
+        default_data_collator = CustomCollatorWithPadding(tokenizer)
+        all_cur_acc = []
+        all_total_acc = []
+        all_total_hit = []
+        seen_labels = []
+        for task_idx, cur_labels in enumerate(task_labels):
+            self.task_idx = task_idx
+            seen_labels += cur_labels
+            cur_acc, _ = self.eval(
+                model=model,
+                eval_dataset=BaseDataset(data.filter(cur_labels, 'test')),
+                data_collator=default_data_collator,
+                seen_labels=seen_labels,
+                label2task_id=copy.deepcopy(data.label2task_id),
+                oracle=True,
+            )
+            total_acc, total_hit = self.eval(
+                model=model,
+                eval_dataset=BaseDataset(data.filter(seen_labels, 'test')),
+                data_collator=default_data_collator,
+                seen_labels=seen_labels,
+                label2task_id=copy.deepcopy(data.label2task_id),
+            )
+            all_cur_acc.append(cur_acc)
+            all_total_acc.append(total_acc)
+            all_total_hit.append(total_hit)
+            log_metrics({"eval/cur_acc": cur_acc, "eval/total_acc": total_acc, "eval/total_hit": total_hit})
+        logger.info("resident memory after evaluating {}: {:.0f} MB".format(path, resident_memory_mb()))
+        flush_checkpoints()
+        model.close()
 
         return {
             "cur_acc": all_cur_acc,
@@ -140,11 +310,220 @@ class EoETrainer(BaseTrainer):
             "total_hit": all_total_hit,
         }
 
-    def train(self, model, train_dataset, data_collator):
+    def prepare_task(self, data, model, tokenizer, label_order, seed, task_idx, seen_labels, marker_ids, augment=True):
+        """
+        Add the labels of task_idx to data and seen_labels and build its training data with the descriptions of
+        the current and the old labels. With augment=False the augmented data isn't built and None is returned
+        for it and its number of labels.
+        """
+        if model.independent_tasks:
+            # every task starts from its own seed, so that an expert can be trained without the earlier ones
+            set_seed(seed + task_idx)
+        cur_labels = [data.label_list[c] for c in label_order[task_idx]]
+        data.add_labels(cur_labels, task_idx)
+
+        logger.info(f"***** Task-{task_idx + 1} *****")
+        logger.info(f"Current classes: {' '.join(cur_labels)}")
+
+        train_data = data.filter(cur_labels, "train")
+        train_dataset = BaseDataset(train_data)
+
+        for cur_label in cur_labels:
+            model.take_generate_description_MrLinh_from_file(cur_label, data.label2id[cur_label], self.args.dataset_name, tokenizer)
+
+        pool = model.get_description_ids(cur_labels)
+        old_pool = model.get_description_ids(seen_labels)
+        train_data_have_des = data.filter_and_add_desciption_and_old_description(cur_labels, pool, seen_labels, old_pool)
+
+        seen_labels += cur_labels
+        if not augment:
+            return cur_labels, train_dataset, None, None
+
+        aug_train_data, num_train_labels = relation_data_augmentation(
+            copy.deepcopy(train_data_have_des), len(seen_labels), copy.deepcopy(data.id2label), marker_ids, self.args.augment_type
+        )
+        aug_train_dataset = BaseDataset(aug_train_data)
+        return cur_labels, train_dataset, aug_train_dataset, num_train_labels
+
+    def save_resume_state(self, ckpt_dir, model, state):
+        """
+        Save the state after task state["task_idx"] to ckpt_dir. The expert of the task is frozen from now on and
+        written once to resume-expert-<task>.pt, resume.pt is overwritten with the shared weights, the statistics
+        and state. The files are queued in this order and each is written to a temporary file and renamed, so
+        that a crash while writing keeps the previous state.
+        """
+        task_idx = state["task_idx"]
+        save_checkpoint(model.expert_state_dict(task_idx), f"{ckpt_dir}/resume-expert-{task_idx}.pt")
+        save_checkpoint({
+            **state,
+            "model": model.task_state_dict(),
+            "distribution": model.resume_distributions(),
+        }, f"{ckpt_dir}/resume.pt")
+        logger.info(f"save the state after task {task_idx + 1} to {ckpt_dir}/resume.pt")
+
+    def load_resume_state(self, ckpt_dir):
+        # the processes of a torchrun job load the state written by the main process onto their own device
+        map_location = {f"cuda:{i}": str(self.args.device) for i in range(torch.cuda.device_count())}
+        # the state holds the python and numpy rng states next to the tensors
+        state = torch.load(f"{ckpt_dir}/resume.pt", map_location=map_location, weights_only=False)
+        for e_id in range(state["task_idx"] + 1):
+            state["model"].update(torch.load(f"{ckpt_dir}/resume-expert-{e_id}.pt", map_location=map_location))
+        return state
+
+    def train_expert(self, data, tokenizer, label_order, seed, task_idx, ckpt_dir):
+        """
+        Train the expert of task_idx on a fresh model and save its adapter and classifier to ckpt_dir. The
+        earlier tasks are replayed without training, the expert only depends on the first-task model.
+        """
+        model = EoE(self.args)
+        model.to(self.args.device)
+        seen_labels = []
+        marker_ids = tuple([tokenizer.convert_tokens_to_ids(c) for c in self.args.additional_special_tokens])
+        for k in range(task_idx + 1):
+            self.task_idx = k
+            _, _, aug_train_dataset, num_train_labels = self.prepare_task(
+                data, model, tokenizer, label_order, seed, k, seen_labels, marker_ids
+            )
+            model.new_task(num_train_labels)
+            if k == 0:
+                model.load_expert_model(f"./ckpt/{self.args.dataset_name}_{seed}_{self.args.augment_type}.pth")
+            if k < task_idx:
+                model.feature_extractor.register_adapter(k, save_dir=ckpt_dir, save=False)
+        self.train(
+            model=model,
+            train_dataset=aug_train_dataset,
+            data_collator=CustomCollatorWithPadding(tokenizer),
+            data_parallel=False,
+        )
+        os.makedirs(ckpt_dir, exist_ok=True)
+        model.save_classifier(idx=task_idx, save_dir=ckpt_dir)
+        model.feature_extractor.register_adapter(task_idx, save_dir=ckpt_dir, save=True)
+        flush_checkpoints()
+        model.close()
+
+    def train_experts_in_parallel(self, data, tokenizer, label_order, seed, ckpt_dir):
+        """
+        Train the experts of tasks 1..num_tasks-1 concurrently: under torchrun the tasks are split over the
+        processes, otherwise they run in expert_train_workers spawned processes.
+        """
+        if self.args.peft_type != "lora":
+            raise NotImplementedError
+        task_ids = list(range(1, self.args.num_tasks))
+        workers = self.args.expert_train_workers if hasattr(self.args, "expert_train_workers") else 0
+        start_time = time.perf_counter()
+        if is_distributed():
+            for task_idx in task_ids[get_rank()::get_world_size()]:
+                self.train_expert(copy.deepcopy(data), tokenizer, label_order, seed, task_idx, ckpt_dir)
+            barrier()
+        elif workers > 0:
+            num_threads = max(1, (os.cpu_count() or 1) // workers)
+            context = multiprocessing.get_context("spawn")
+            with ProcessPoolExecutor(max_workers=workers, mp_context=context) as executor:
+                futures = [
+                    executor.submit(
+                        train_expert_in_worker, self.args, data, tokenizer, label_order, seed, task_idx, ckpt_dir,
+                        num_threads,
+                    )
+                    for task_idx in task_ids
+                ]
+                for future in futures:
+                    future.result()
+        else:
+            for task_idx in task_ids:
+                self.train_expert(copy.deepcopy(data), tokenizer, label_order, seed, task_idx, ckpt_dir)
+        logger.info("Trained {} experts in {:.2f}s".format(len(task_ids), time.perf_counter() - start_time))
+
+    def load_trained_model(self, data, tokenizer, label_order, seed, ckpt_dir):
+        """
+        Rebuild the model of a run whose experts are all saved in ckpt_dir, with the experts of every task
+        registered. Also returns the training dataset of each task.
+        """
+        start_time = time.perf_counter()
+        data = copy.deepcopy(data)
+        model = EoE(self.args)
+        model.to(self.args.device)
+        seen_labels = []
+        train_datasets = []
+        marker_ids = tuple([tokenizer.convert_tokens_to_ids(c) for c in self.args.additional_special_tokens])
+        for k in range(self.args.num_tasks):
+            self.task_idx = k
+            _, train_dataset, _, num_train_labels = self.prepare_task(
+                data, model, tokenizer, label_order, seed, k, seen_labels, marker_ids
+            )
+            model.new_task(num_train_labels)
+            if k == 0:
+                model.load_expert_model(f"./ckpt/{self.args.dataset_name}_{seed}_{self.args.augment_type}.pth")
+            else:
+                model.load_classifier(k, ckpt_dir)
+                model.feature_extractor.load_adapter_weights(k, ckpt_dir)
+            model.feature_extractor.register_adapter(k, save_dir=ckpt_dir, save=False)
+            train_datasets.append(train_dataset)
+        logger.info("load the experts from {} in {:.2f}s, resident memory {:.0f} MB".format(
+            ckpt_dir, time.perf_counter() - start_time, resident_memory_mb()))
+        return model, train_datasets
+
+    def compute_statistic_cells(self, model, train_datasets, data_collator, cells):
+        return {
+            (expert_id, task_idx): self.get_mean_and_cov(
+                model, train_datasets[task_idx], data_collator, expert_id, local=True
+            )
+            for expert_id, task_idx in cells
+        }
+
+    def start_statistic_workers(self, data, tokenizer, label_order, seed, ckpt_dir):
+        """
+        Spawn statistic_workers processes that each load the trained model of a run whose experts are all saved
+        in ckpt_dir, for statistic_grid. Returns None without statistic_workers or under torchrun.
+        """
+        workers = self.args.statistic_workers if hasattr(self.args, "statistic_workers") else 0
+        if workers <= 0 or is_distributed():
+            return None
+        num_threads = max(1, (os.cpu_count() or 1) // workers)
+        return ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=init_statistic_worker,
+            initargs=(self.args, data, tokenizer, label_order, seed, ckpt_dir, num_threads),
+        )
+
+    def statistic_grid(self, model, dataset, data_collator, executor=None):
+        """
+        Statistics of the (expert, task) cells of the current task, expert i encodes the training data of the
+        task for every i <= task_idx, in a run whose experts are all saved. Under torchrun the cells are split
+        over the processes, each encodes its cells with its own copy of model and the cells of the task are
+        merged; with the statistic worker processes of executor they are split over the workers. Otherwise
+        None is returned and statistic computes the cells one by one. The results are keyed by cell, so that
+        statistic merges them in the same order whatever the split, and only one task is held at a time.
+        """
+        if self.args.peft_type != "lora":
+            raise NotImplementedError
+        cells = [(i, self.task_idx) for i in range(-1, self.task_idx + 1)]
+        start_time = time.perf_counter()
+        if is_distributed():
+            results = self.compute_statistic_cells(
+                model, {self.task_idx: dataset}, data_collator, cells[get_rank()::get_world_size()]
+            )
+            results = dict(gather_shards(list(results.items())))
+        elif executor is not None:
+            workers = self.args.statistic_workers
+            futures = [executor.submit(statistic_cells_in_worker, cells[i::workers]) for i in range(workers)]
+            results = {}
+            for future in futures:
+                results.update(future.result())
+        else:
+            return None
+        logger.info("Computed {} statistic cells in {:.2f}s".format(len(cells), time.perf_counter() - start_time))
+        return results
+
+    def train(self, model, train_dataset, data_collator, data_parallel=True):
+        # each process trains on its own shard of the data under torchrun
+        data_parallel = data_parallel and is_distributed()
+        sampler = DistributedSampler(train_dataset, shuffle=True) if data_parallel else None
         train_dataloader = DataLoader(
             train_dataset,
             batch_size=self.args.train_batch_size,
-            shuffle=True,
+            shuffle=sampler is None,
+            sampler=sampler,
             collate_fn=data_collator
         )
         len_dataloader = len(train_dataloader)
@@ -170,19 +549,23 @@ class EoETrainer(BaseTrainer):
         ]
         self.optimizer = AdamW(parameters)
 
-        progress_bar = tqdm(range(max_steps))
+        progress_bar = tqdm(range(max_steps), disable=data_parallel and not is_main_process())
         for name, param in model.named_parameters():
             if param.requires_grad and "lora_" in name:
                 print(name)
                 break
 
+        start_time = time.perf_counter()
+        train_model = wrap_model(model) if data_parallel else model
         for epoch in range(self.args.num_train_epochs):
-            model.train()
+            if sampler is not None:
+                sampler.set_epoch(epoch)
+            train_model.train()
             for step, inputs in enumerate(train_dataloader):
                 self.optimizer.zero_grad()
 
                 inputs = {k: v.to(self.args.device) for k, v in inputs.items()}
-                outputs = model(**inputs)
+                outputs = train_model(**inputs)
                 loss = outputs.loss
                 loss.backward()
                 nn.utils.clip_grad_norm_(model.parameters(), self.args.max_grad_norm)
@@ -190,14 +573,26 @@ class EoETrainer(BaseTrainer):
                 self.optimizer.step()
 
                 progress_bar.update(1)
-                progress_bar.set_postfix({"Loss": loss.item()})
+                # the loss logged by the model at an earlier step as written out by the metrics thread,
+                # loss.item() would wait for the device on every step
+                loss_value = latest_metric(f"train/total_loss_{model.num_tasks}")
+                if loss_value is not None:
+                    progress_bar.set_postfix({"Loss": loss_value}, refresh=False)
 
         progress_bar.close()
+        train_time = time.perf_counter() - start_time
+        logger.info("Train time {:.2f}s ({:.2f} samples/s)".format(
+            train_time, num_examples * self.args.num_train_epochs / max(train_time, 1e-8)
+        ))
+        if model.description_bank is not None:
+            lookups = max(model.description_bank_hits + model.description_bank_misses, 1)
+            logger.info("Description bank hit rate {:.2f}".format(model.description_bank_hits / lookups))
 
     @torch.no_grad()
     def eval(self, model, eval_dataset, data_collator, seen_labels, label2task_id, oracle=False):
+        # each process evaluates a strided shard, the per-sample outputs are gathered in dataset order
         eval_dataloader = DataLoader(
-            eval_dataset,
+            shard_dataset(eval_dataset),
             batch_size=self.args.eval_batch_size,
             shuffle=False,
             collate_fn=data_collator,
@@ -210,7 +605,7 @@ class EoETrainer(BaseTrainer):
         logger.info(f"  Num examples = {num_examples}")
         logger.info(f"  Eval batch size = {self.args.eval_batch_size}")
 
-        progress_bar = tqdm(range(len_dataloader))
+        progress_bar = tqdm(range(len_dataloader), disable=not is_main_process())
 
         golds = []
         preds = []
@@ -220,6 +615,11 @@ class EoETrainer(BaseTrainer):
         expert_class_preds = []
         hits = 0
         model.eval()
+        if model.expert_store is not None:
+            model.expert_store.reset_stats()
+        model.num_expert_passes = 0
+        model.routing_times = []
+        start_time = time.perf_counter()
         for step, inputs in enumerate(eval_dataloader):
 
             inputs = {k: v.to(self.args.device) for k, v in inputs.items()}
@@ -237,21 +637,40 @@ class EoETrainer(BaseTrainer):
             golds.extend(labels)
             preds.extend(predicts)
 
-            expert_task_preds.append(outputs.expert_task_preds)
-            expert_class_preds.append(outputs.expert_class_preds)
+            if not oracle:
+                # kept on the device, moved to the host once after the loop
+                expert_task_preds.append(outputs.expert_task_preds)
+                expert_class_preds.append(outputs.expert_class_preds)
 
             progress_bar.update(1)
         progress_bar.close()
+        golds = gather_shards(golds)
+        preds = gather_shards(preds)
+        gold_indices = gather_shards(gold_indices)
+        pred_indices = gather_shards(pred_indices)
+        expert_task_preds = gather_shards(torch.cat(expert_task_preds).tolist() if expert_task_preds else [])
+        expert_class_preds = gather_shards(torch.cat(expert_class_preds).tolist() if expert_class_preds else [])
+        num_expert_passes = sum(gather_shards([model.num_expert_passes]))
+        eval_time = time.perf_counter() - start_time
 
         logger.info("\n" + metrics.classification_report(golds, preds))
         acc = metrics.accuracy_score(golds, preds)
         hit_acc = metrics.accuracy_score(gold_indices, pred_indices)
         logger.info("Acc {}".format(acc))
         logger.info("Hit Acc {}".format(hit_acc))
-
-        if not oracle:
-            expert_task_preds = torch.cat(expert_task_preds, dim=0).tolist()
-            expert_class_preds = torch.cat(expert_class_preds, dim=0).tolist()
+        logger.info("Eval time {:.2f}s ({:.2f} ms/sample)".format(eval_time, 1000 * eval_time / max(num_examples, 1)))
+        if model.profile_routing:
+            routing_time = sum(gather_shards([sum(model.routing_times)]))
+            logger.info("Routing time {:.2f}s ({:.3f} ms/sample)".format(
+                routing_time, 1000 * routing_time / max(num_examples, 1)))
+        logger.info("Expert passes per sample {:.2f}".format(num_expert_passes / max(num_examples, 1)))
+        if model.expert_store is not None:
+            store_stats = model.expert_store.stats()
+            logger.info("Expert store: {}".format(", ".join(f"{k} {v:.2f}" if isinstance(v, float) else f"{k} {v}"
+                                                            for k, v in store_stats.items())))
+            log_metrics({f"expert_store/{k}": v for k, v in store_stats.items()})
+
+        if not oracle and is_main_process():
             save_data = {
                 "preds": preds,
                 "golds": golds,
@@ -262,21 +681,31 @@ class EoETrainer(BaseTrainer):
             }
             # save information
             save_file = f"{self.cur_seed}_{self.task_idx}.pickle"
-            save_dir = hydra.core.hydra_config.HydraConfig.get().runtime.output_dir
-            with open(save_dir + "/" + save_file, 'wb') as file:
-                pickle.dump(save_data, file)
+            save_dir = self.args.run_dir
+            save_checkpoint(save_data, save_dir + "/" + save_file, write=pickle_dump)
 
         return acc, hit_acc
 
-    def statistic(self, model, dataset, data_collator):
+    def statistic(self, model, dataset, data_collator, cells=None):
         for i in range(-1, self.task_idx + 1):
-            mean, cov, task_mean, task_cov = self.get_mean_and_cov(model, dataset, data_collator, i)
+            if cells is not None:
+                # consumed in (task, expert) order, the same order in which they are computed below
+                mean, cov, task_mean, task_cov = cells.pop((i, self.task_idx))
+            else:
+                mean, cov, task_mean, task_cov = self.get_mean_and_cov(model, dataset, data_collator, i)
             model.new_statistic(mean, cov, task_mean, task_cov, i)
 
     @torch.no_grad()
-    def get_mean_and_cov(self, model, dataset, data_collator, expert_id=0):
+    def get_mean_and_cov(self, model, dataset, data_collator, expert_id=0, local=False):
+        """
+        Class means, the covariance shared by the classes and the task-level gaussian of the features of an
+        expert. Each process encodes a strided shard and the per-class counts, sums and outer-product sums
+        are summed over the processes in float64. The summation order changes with the number of processes, so
+        the result matches the single-process one up to float64 rounding.
+        With local=True the process encodes the whole dataset on its own, as for the cells of statistic_grid.
+        """
         loader = DataLoader(
-            dataset,
+            dataset if local else shard_dataset(dataset),
             batch_size=self.args.eval_batch_size,
             shuffle=False,
             collate_fn=data_collator,
@@ -293,31 +722,39 @@ class EoETrainer(BaseTrainer):
             inputs.update({"task_idx": expert_id})
 
             prelogit = model(**inputs)
-            # print(prelogit.shape)
-            prelogits.extend(prelogit.tolist())
-            labels.extend(label.tolist())
-
-        prelogits = torch.tensor(prelogits)
-        labels = torch.tensor(labels)
-        labels_space = torch.unique(labels)
-
-        task_mean = prelogits.mean(dim=0)
-        task_cov = torch.cov((prelogits - task_mean).T)
-
-        mean_over_classes = []
-        cov_over_classes = []
-        for c in labels_space:
+            prelogits.append(prelogit.double())
+            labels.append(label.to(self.args.device))
+
+        # only the distinct labels of each process are gathered
+        labels_space = set(torch.cat(labels).unique().tolist()) if labels else set()
+        labels_space = sorted(labels_space if local else set().union(*gather_objects(labels_space)))
+        hidden_size = prelogits[0].size(-1) if prelogits else model.query_size
+        prelogits = torch.cat(prelogits) if prelogits else \
+            torch.zeros(0, hidden_size, dtype=torch.float64, device=self.args.device)
+        labels = torch.cat(labels) if labels else torch.zeros(0, dtype=torch.long, device=self.args.device)
+
+        counts = torch.zeros(len(labels_space), dtype=torch.float64, device=self.args.device)
+        sums = torch.zeros(len(labels_space), hidden_size, dtype=torch.float64, device=self.args.device)
+        outer_sums = torch.zeros(len(labels_space), hidden_size, hidden_size, dtype=torch.float64,
+                                 device=self.args.device)
+        for i, c in enumerate(labels_space):
             embeds = prelogits[labels == c]
-            if embeds.numel() > 0:
-                mean = embeds.mean(dim=0)
-                cov = torch.cov((embeds - mean).T)
-            else:
-                mean = task_mean
-                cov = task_cov
-            mean_over_classes.append(mean)
-            cov_over_classes.append(cov)
-
-        mean_over_classes = torch.stack(mean_over_classes)
-        shared_cov = torch.stack(cov_over_classes).mean(dim=0)
-
-        return mean_over_classes, shared_cov, task_mean, task_cov
+            counts[i] = embeds.size(0)
+            sums[i] = embeds.sum(dim=0)
+            outer_sums[i] = embeds.T @ embeds
+        if not local:
+            all_reduce_sum(counts)
+            all_reduce_sum(sums)
+            all_reduce_sum(outer_sums)
+
+        num_samples = counts.sum()
+        task_mean = sums.sum(dim=0) / num_samples
+        task_cov = (outer_sums.sum(dim=0) - num_samples * torch.outer(task_mean, task_mean)) / (num_samples - 1)
+
+        mean_over_classes = sums / counts.unsqueeze(-1)
+        cov_over_classes = (outer_sums - counts.view(-1, 1, 1) * mean_over_classes.unsqueeze(-1)
+                            * mean_over_classes.unsqueeze(1)) / (counts.view(-1, 1, 1) - 1)
+        shared_cov = cov_over_classes.mean(dim=0)
+
+        return mean_over_classes.float().cpu(), shared_cov.float().cpu(), task_mean.float().cpu(), \
+            task_cov.float().cpu()
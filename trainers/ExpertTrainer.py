@@ -5,7 +5,7 @@ from typing import List, Dict, Any, Optional, Union
 import torch
 from attr import dataclass
 from matplotlib import pyplot as plt
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, DistributedSampler
 from transformers import DataCollatorWithPadding, set_seed, PreTrainedTokenizerBase
 from torch.optim import AdamW
 from transformers.utils import PaddingStrategy
@@ -18,6 +18,8 @@ import numpy as np
 from sklearn import metrics
 from sklearn import manifold
 from utils import relation_data_augmentation, CustomCollatorWithPadding
+from utils import is_distributed, is_main_process, barrier, wrap_model, unwrap_model
+from utils import save_checkpoint, flush_checkpoints, log_metrics, latest_metric
 
 logger = logging.getLogger(__name__)
 
@@ -31,6 +33,7 @@ class ExpertTrainer:
     def run(self, data, model, tokenizer, label_order, seed=None):
         if seed is not None:
             set_seed(seed)
+        model = unwrap_model(model)
         default_data_collator = CustomCollatorWithPadding(tokenizer)
 
         seen_labels = []
@@ -72,11 +75,14 @@ class ExpertTrainer:
                 seen_labels=seen_labels,
             )
 
-            os.makedirs(self.args.save_model_dir, exist_ok=True)
             save_model_name = f"{self.args.dataset_name}_{seed}_{self.args.augment_type}.pth"
             save_model_path = os.path.join(self.args.save_model_dir, save_model_name)
-            logger.info(f"save expert model to {save_model_path}")
-            self.save_model(model, save_model_path)
+            # the processes hold the same weights after training, only the main process writes them
+            if is_main_process():
+                os.makedirs(self.args.save_model_dir, exist_ok=True)
+                logger.info(f"save expert model to {save_model_path}")
+                self.save_model(model, save_model_path)
+            barrier()
 
             all_cur_acc[self.task_idx] = cur_result
             all_total_acc[self.task_idx] = cur_result
@@ -85,6 +91,7 @@ class ExpertTrainer:
             if self.task_idx == 0:
                 break
 
+        flush_checkpoints()
         return {
             "cur_acc": all_cur_acc,
             "total_acc": all_total_acc,
@@ -92,10 +99,13 @@ class ExpertTrainer:
         }
 
     def train(self, model, train_dataset, data_collator):
+        # each process trains on its own shard of the data under torchrun
+        sampler = DistributedSampler(train_dataset, shuffle=True) if is_distributed() else None
         train_dataloader = DataLoader(
             train_dataset,
             batch_size=self.args.train_batch_size,
-            shuffle=True,
+            shuffle=sampler is None,
+            sampler=sampler,
             collate_fn=data_collator
         )
         len_dataloader = len(train_dataloader)
@@ -121,27 +131,35 @@ class ExpertTrainer:
         ]
         self.optimizer = AdamW(parameters)
 
-        progress_bar = tqdm(range(max_steps))
+        progress_bar = tqdm(range(max_steps), disable=not is_main_process())
 
         # for name, param in model.named_parameters():
         #     if param.requires_grad:
         #         print(name)
 
+        train_model = wrap_model(model)
         for epoch in range(self.args.num_train_epochs):
-            model.train()
+            if sampler is not None:
+                sampler.set_epoch(epoch)
+            train_model.train()
             for step, inputs in enumerate(train_dataloader):
                 self.optimizer.zero_grad()
 
                 inputs = {k: v.to(self.args.device) for k, v in inputs.items()}
-                outputs = model(**inputs)
+                outputs = train_model(**inputs)
                 loss = outputs.loss
                 loss.backward()
                 nn.utils.clip_grad_norm_(model.parameters(), self.args.max_grad_norm)
 
                 self.optimizer.step()
 
+                log_metrics({"train/loss": loss})
                 progress_bar.update(1)
-                progress_bar.set_postfix({"Loss": loss.item()})
+                # the loss of an earlier step as written out by the metrics thread, loss.item() would wait for
+                # the device on every step
+                loss_value = latest_metric("train/loss")
+                if loss_value is not None:
+                    progress_bar.set_postfix({"Loss": loss_value}, refresh=False)
 
         progress_bar.close()
 
@@ -161,7 +179,7 @@ class ExpertTrainer:
         logger.info(f"  Num examples = {num_examples}")
         logger.info(f"  Eval batch size = {self.args.eval_batch_size}")
 
-        progress_bar = tqdm(range(len_dataloader))
+        progress_bar = tqdm(range(len_dataloader), disable=not is_main_process())
 
         golds = []
         preds = []
@@ -193,7 +211,7 @@ class ExpertTrainer:
     def save_model(self, model, save_path):
         bert_state_dict = model.feature_extractor.bert.state_dict()
         linear_state_dict = model.classifier.state_dict()
-        torch.save({
+        save_checkpoint({
             "model": bert_state_dict,
             "linear": linear_state_dict,
         }, save_path)
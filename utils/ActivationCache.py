@@ -0,0 +1,98 @@
+import atexit
+import os
+
+import numpy as np
+import torch
+
+
+class TrunkActivationCache:
+    """
+    Memory-mapped store of the hidden states that leave the frozen trunk, keyed by the token ids of a
+    sequence. Only the non-padding positions are stored since they don't depend on the padding of a batch.
+    With max_bytes, sequences that don't fit anymore are not stored: the training epochs visit the sequences
+    in a new random order, so keeping the stored ones gives more hits than replacing them. The entries are
+    evicted together by clear. The file belongs to this process and is deleted by close, at the latest when
+    the process exits.
+    """
+
+    def __init__(self, path, hidden_size, dtype=np.float32, max_bytes=None):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.path = path
+        self.hidden_size = hidden_size
+        self.dtype = np.dtype(dtype)
+        self.max_rows = max_bytes // (hidden_size * self.dtype.itemsize) if max_bytes is not None else None
+        self.file = open(path, "wb+")
+        self.index = {}
+        self.num_rows = 0
+        self.storage = None
+        atexit.register(self.close)
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, key):
+        return key in self.index
+
+    def map(self, num_rows):
+        if self.storage is None or num_rows > self.storage.shape[0]:
+            # rows were appended since the file was mapped
+            self.file.flush()
+            self.storage = np.memmap(self.path, dtype=self.dtype, mode="r", shape=(self.num_rows, self.hidden_size))
+        return self.storage
+
+    def get(self, key):
+        offset, length = self.index[key]
+        return torch.from_numpy(np.array(self.map(offset + length)[offset: offset + length]))
+
+    def get_many(self, keys):
+        """
+        The rows of all keys concatenated in key order, read with one gather from the mapped file.
+        """
+        spans = [self.index[key] for key in keys]
+        rows = np.concatenate([np.arange(offset, offset + length) for offset, length in spans])
+        storage = self.map(max(offset + length for offset, length in spans))
+        return torch.from_numpy(np.take(storage, rows, axis=0))
+
+    def put(self, key, hidden_states):
+        self.put_many([key], [hidden_states])
+
+    def put_many(self, keys, hidden_states):
+        """
+        Append the hidden states of several keys with one write, keys already in the cache are skipped and so
+        are the keys that don't fit into max_bytes.
+        """
+        new = {}
+        num_rows = self.num_rows
+        for key, states in zip(keys, hidden_states):
+            if key not in self.index and key not in new and \
+                    (self.max_rows is None or num_rows + states.shape[0] <= self.max_rows):
+                new[key] = states
+                num_rows += states.shape[0]
+        if len(new) == 0:
+            return
+        array = torch.cat(list(new.values())).detach().cpu().numpy().astype(self.dtype)
+        self.file.write(array.tobytes())
+        for key, states in new.items():
+            self.index[key] = (self.num_rows, states.shape[0])
+            self.num_rows += states.shape[0]
+
+    def clear(self):
+        self.storage = None
+        self.file.seek(0)
+        self.file.truncate()
+        self.index = {}
+        self.num_rows = 0
+
+    def close(self):
+        """
+        Close and delete the cache file.
+        """
+        if self.file.closed:
+            return
+        atexit.unregister(self.close)
+        self.storage = None
+        self.index = {}
+        self.num_rows = 0
+        self.file.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
@@ -0,0 +1,184 @@
+import atexit
+import copy
+import json
+import logging
+import os
+import pickle
+import queue
+import threading
+
+import psutil
+import torch
+from safetensors import safe_open
+from safetensors.torch import save_file
+
+logger = logging.getLogger(__name__)
+
+
+def snapshot(obj):
+    """
+    Copy of obj that the training loop can't change anymore: tensors are copied to host memory and the
+    containers and other values are copied.
+    """
+    if isinstance(obj, torch.Tensor):
+        if getattr(obj, "mapped", False):
+            return obj
+        return obj.detach().to("cpu", copy=True).contiguous()
+    if isinstance(obj, dict):
+        return type(obj)((k, snapshot(v)) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(snapshot(v) for v in obj)
+    return copy.deepcopy(obj)
+
+
+def mark_mapped(obj):
+    """
+    Mark the tensors in obj as mapped from a file that is replaced but never written in place, snapshot
+    shares them instead of copying them. Returns obj.
+    """
+    if isinstance(obj, torch.Tensor):
+        obj.mapped = True
+    elif isinstance(obj, dict):
+        for v in obj.values():
+            mark_mapped(v)
+    elif isinstance(obj, (list, tuple)):
+        for v in obj:
+            mark_mapped(v)
+    return obj
+
+
+def torch_save(obj, path):
+    torch.save(obj, path)
+
+
+def pickle_dump(obj, path):
+    with open(path, "wb") as file:
+        pickle.dump(obj, file)
+
+
+def safetensors_save(obj, path):
+    save_file(obj, path, metadata={"format": "pt"})
+
+
+def packed_save(obj, path):
+    """
+    Write a (tensors, metadata) pair as a packed checkpoint: one safetensors file, the json metadata is
+    stored in its header.
+    """
+    tensors, metadata = obj
+    save_file(tensors, path, metadata={"format": "pt", "metadata": json.dumps(metadata)})
+
+
+def resident_memory_mb():
+    return psutil.Process().memory_info().rss / 2 ** 20
+
+
+class PackedCheckpoint:
+    """
+    Read-only view of a packed checkpoint. The file is memory-mapped and a tensor is only read from it when
+    it is requested, so a process only pays for the tensors it uses.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.file = safe_open(path, framework="pt", device="cpu")
+        self.metadata = json.loads(self.file.metadata()["metadata"])
+        self.names = list(self.file.keys())
+
+    def __contains__(self, name):
+        return name in self.names
+
+    def get(self, name):
+        return self.file.get_tensor(name)
+
+    def get_prefix(self, prefix):
+        """
+        The tensors whose names start with prefix, keyed by the rest of their name.
+        """
+        return {name[len(prefix):]: self.get(name) for name in self.names if name.startswith(prefix)}
+
+
+class AsyncCheckpointWriter:
+    """
+    Write checkpoints without blocking the training loop. save takes a snapshot of the object in host
+    memory and hands it to a background thread, which writes it to a temporary file and renames it, so a
+    checkpoint file is either complete or absent. flush waits until all queued checkpoints are written.
+    """
+
+    def __init__(self, async_write=True):
+        self.async_write = async_write
+        self.queue = queue.Queue()
+        self.thread = None
+        self.errors = []
+
+    def save(self, obj, path, write=torch_save):
+        obj = snapshot(obj)
+        if not self.async_write:
+            self.write(obj, path, write)
+            return
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.worker, daemon=True)
+            self.thread.start()
+            # finish the queued checkpoints when the process exits on an error
+            atexit.register(self.close)
+        self.queue.put((obj, path, write))
+
+    def write(self, obj, path, write):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        write(obj, f"{path}.tmp")
+        os.replace(f"{path}.tmp", path)
+
+    def worker(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                obj, path, write = item
+                try:
+                    self.write(obj, path, write)
+                except Exception as e:
+                    logger.error(f"failed to write checkpoint {path}: {e}")
+                    self.errors.append((path, e))
+            finally:
+                self.queue.task_done()
+
+    def flush(self):
+        """
+        Wait until the queued checkpoints are written, and raise if one of them failed.
+        """
+        if self.thread is not None:
+            self.queue.join()
+        if len(self.errors) > 0:
+            path, error = self.errors[0]
+            self.errors = []
+            raise RuntimeError(f"failed to write checkpoint {path}") from error
+
+    def close(self):
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+        self.flush()
+
+
+checkpoint_writer = AsyncCheckpointWriter()
+
+
+def setup_checkpoints(async_write=True):
+    global checkpoint_writer
+    checkpoint_writer.close()
+    checkpoint_writer = AsyncCheckpointWriter(async_write)
+    return checkpoint_writer
+
+
+def save_checkpoint(obj, path, write=torch_save):
+    checkpoint_writer.save(obj, path, write)
+
+
+def flush_checkpoints():
+    checkpoint_writer.flush()
+
+
+def close_checkpoints():
+    checkpoint_writer.close()
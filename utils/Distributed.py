@@ -0,0 +1,103 @@
+import os
+
+import torch
+import torch.distributed as dist
+import torch.nn as nn
+from torch.nn.parallel import DistributedDataParallel as DDP
+from torch.utils.data import Subset
+
+
+def init_distributed(device):
+    """
+    Join the process group set up by torchrun (WORLD_SIZE > 1) and return the device of this process:
+    cuda:{LOCAL_RANK} with nccl, or the given device with gloo on cpu.
+    """
+    if int(os.environ.get("WORLD_SIZE", 1)) <= 1 or is_distributed():
+        return device
+    if str(device).startswith("cuda") and torch.cuda.is_available():
+        local_rank = int(os.environ.get("LOCAL_RANK", 0))
+        torch.cuda.set_device(local_rank)
+        dist.init_process_group(backend="nccl")
+        return f"cuda:{local_rank}"
+    dist.init_process_group(backend="gloo")
+    return "cpu"
+
+
+def cleanup_distributed():
+    if is_distributed():
+        dist.destroy_process_group()
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+
+def get_rank():
+    return dist.get_rank() if is_distributed() else 0
+
+
+def get_world_size():
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def is_main_process():
+    return get_rank() == 0
+
+
+def barrier():
+    if is_distributed():
+        dist.barrier()
+
+
+def wrap_model(model):
+    """
+    Wrap the model for one training phase. The parameters of EoE change with every task, so the model is
+    wrapped again for each task instead of once at startup.
+    """
+    if not is_distributed():
+        return model
+    device_ids = [torch.cuda.current_device()] if next(model.parameters()).is_cuda else None
+    # the description branch and the frozen experts leave parameters without gradients
+    return DDP(model, device_ids=device_ids, find_unused_parameters=True)
+
+
+def unwrap_model(model):
+    return model.module if isinstance(model, (DDP, nn.DataParallel)) else model
+
+
+def shard_dataset(dataset):
+    """
+    Strided shard of the dataset for this process: samples rank, rank + world_size, ...
+    """
+    if not is_distributed():
+        return dataset
+    return Subset(dataset, list(range(get_rank(), len(dataset), get_world_size())))
+
+
+def gather_shards(items):
+    """
+    Gather the per-sample items computed on the shards of shard_dataset from all processes, in dataset order.
+    """
+    if not is_distributed():
+        return items
+    shards = [None] * get_world_size()
+    dist.all_gather_object(shards, list(items))
+    num_items = sum(len(shard) for shard in shards)
+    return [shards[i % len(shards)][i // len(shards)] for i in range(num_items)]
+
+
+def gather_objects(obj):
+    """
+    The objects of all processes in rank order, e.g. small per-process summaries.
+    """
+    if not is_distributed():
+        return [obj]
+    objects = [None] * get_world_size()
+    dist.all_gather_object(objects, obj)
+    return objects
+
+
+def all_reduce_sum(tensor):
+    if is_distributed():
+        dist.all_reduce(tensor, op=dist.ReduceOp.SUM)
+    return tensor
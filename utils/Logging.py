@@ -0,0 +1,24 @@
+import logging
+import os
+import sys
+
+
+def setup_logging(log_file=None, level=logging.INFO):
+    """
+    Log to stdout in the format of the run. A spawned worker process passes the log file of the run, which
+    hydra opened in the main process, so that its records are appended to it too. The handlers a worker
+    got from importing the main module are replaced. level is set on the root logger, also when its handlers
+    are kept, so that it applies to the loggers of all modules.
+    """
+    handlers = [logging.StreamHandler(sys.stdout)]
+    if log_file is not None:
+        os.makedirs(os.path.dirname(log_file) or ".", exist_ok=True)
+        handlers.append(logging.FileHandler(log_file))
+    logging.basicConfig(
+        format="%(asctime)s - %(levelname)s - %(name)s - %(message)s",
+        datefmt="%m/%d/%Y %H:%M:%S",
+        level=level,
+        handlers=handlers,
+        force=log_file is not None,
+    )
+    logging.getLogger().setLevel(level)
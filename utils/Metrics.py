@@ -0,0 +1,208 @@
+import csv
+import json
+import logging
+import os
+import queue
+import threading
+import time
+
+import torch
+
+logger = logging.getLogger(__name__)
+
+
+class JsonlSink:
+    """
+    Append one json line per metrics record.
+    """
+
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.file = open(path, "a")
+
+    def write(self, records):
+        for record in records:
+            self.file.write(json.dumps(record) + "\n")
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+class CsvSink:
+    """
+    Append one (step, time, name, value) row per metric, so that records with different keys share a file.
+    """
+
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        write_header = not os.path.exists(path) or os.path.getsize(path) == 0
+        self.file = open(path, "a", newline="")
+        self.writer = csv.writer(self.file)
+        if write_header:
+            self.writer.writerow(["step", "time", "name", "value"])
+
+    def write(self, records):
+        for record in records:
+            for name, value in record.items():
+                if name not in ("step", "time"):
+                    self.writer.writerow([record["step"], record["time"], name, json.dumps(value)])
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+class WandbSink:
+    """
+    Forward the records to wandb. The api key is read from the WANDB_API_KEY environment variable, without it
+    the sink fails at once instead of prompting or logging anonymously.
+    """
+
+    def __init__(self, project, **init_kwargs):
+        if not os.environ.get("WANDB_API_KEY"):
+            raise ValueError("the wandb metrics sink needs the WANDB_API_KEY environment variable")
+        import wandb
+        self.wandb = wandb
+        self.wandb.login(anonymous="never")
+        self.run = self.wandb.init(project=project, **init_kwargs)
+
+    def write(self, records):
+        for record in records:
+            self.run.log({k: v for k, v in record.items() if k not in ("step", "time")})
+
+    def close(self):
+        self.run.finish()
+
+
+class MetricsLogger:
+    """
+    Collect metrics without blocking the training step. A scalar tensor is written to a ring buffer of
+    flush_every slots that the metric keeps on the device of its values, which launches a copy and never
+    waits for the device. When the ring is full, its filled slots are cloned and handed to a background
+    thread, which moves them to the host and writes the records to the sinks. latest holds the last value
+    of every metric written out, e.g. for a progress bar.
+    """
+
+    def __init__(self, sinks=(), flush_every=50):
+        self.sinks = list(sinks)
+        self.flush_every = max(1, flush_every)
+        # metric name -> (flush_every,) ring buffer on the device of the metric
+        self.rings = {}
+        # (record, names of its ring metrics) of the current window, record i is in slot i of the rings
+        self.records = []
+        self.latest = {}
+        self.step = 0
+        self.queue = queue.Queue()
+        self.thread = None
+
+    def log(self, metrics):
+        if len(self.sinks) == 0:
+            return
+        for k, v in metrics.items():
+            if isinstance(v, torch.Tensor) and v.numel() == 1 and k in self.rings and self.rings[k].device != v.device:
+                # the window is written out before a metric moves to another device
+                self.drain()
+                self.rings = {}
+                break
+        slot = len(self.records)
+        record = {}
+        ring_names = []
+        for k, v in metrics.items():
+            if isinstance(v, torch.Tensor) and v.numel() == 1:
+                if k not in self.rings:
+                    self.rings[k] = torch.zeros(self.flush_every, dtype=v.dtype, device=v.device)
+                self.rings[k][slot] = v.detach().reshape(())
+                # filled in from the ring by the background thread
+                record[k] = None
+                ring_names.append(k)
+            else:
+                record[k] = v.detach() if isinstance(v, torch.Tensor) else v
+        record["step"] = self.step
+        record["time"] = time.time()
+        self.step += 1
+        self.records.append((record, ring_names))
+        if len(self.records) >= self.flush_every:
+            self.drain()
+
+    def drain(self):
+        if len(self.records) == 0:
+            return
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.worker, daemon=True)
+            self.thread.start()
+        # the rings are reused for the next window, the worker reads a copy of the filled slots
+        names = set(name for _, ring_names in self.records for name in ring_names)
+        values = {name: self.rings[name][:len(self.records)].clone() for name in names}
+        self.queue.put((self.records, values))
+        self.records = []
+
+    def worker(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                records, values = item
+                values = {name: value.tolist() for name, value in values.items()}
+                host_records = []
+                for slot, (record, ring_names) in enumerate(records):
+                    record = {k: v.tolist() if isinstance(v, torch.Tensor) else v for k, v in record.items()}
+                    for name in ring_names:
+                        record[name] = values[name][slot]
+                    host_records.append(record)
+                    self.latest.update(record)
+                for sink in self.sinks:
+                    try:
+                        sink.write(host_records)
+                    except Exception as e:
+                        logger.warning(f"{type(sink).__name__} failed to write metrics: {e}")
+            finally:
+                self.queue.task_done()
+
+    def flush(self):
+        """
+        Hand over the buffered records and wait until the sinks wrote them.
+        """
+        self.drain()
+        if self.thread is not None:
+            self.queue.join()
+
+    def close(self):
+        self.flush()
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+        for sink in self.sinks:
+            sink.close()
+        self.sinks = []
+
+
+metrics_logger = MetricsLogger()
+
+
+def setup_metrics(sinks, flush_every=50):
+    global metrics_logger
+    metrics_logger.close()
+    metrics_logger = MetricsLogger(sinks, flush_every)
+    return metrics_logger
+
+
+def log_metrics(metrics):
+    metrics_logger.log(metrics)
+
+
+def latest_metric(name, default=None):
+    """
+    Last value of a metric written out by the background thread, without waiting for the device.
+    """
+    return metrics_logger.latest.get(name, default)
+
+
+def flush_metrics():
+    metrics_logger.flush()
+
+
+def close_metrics():
+    metrics_logger.close()
@@ -1,3 +1,8 @@
 from .Distance import *
 from .DataAugmentation import *
 from .DataCollator import *
+from .ActivationCache import *
+from .Metrics import *
+from .Distributed import *
+from .Checkpoint import *
+from .Logging import *